@@ -0,0 +1,77 @@
+import time
+import argparse
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from tiny import tiny_model, random_prompts
+from scheduler import BatchScheduler, GenerationRequest
+
+# Compares the one-prompt-at-a-time model.generate path used by
+# output.generate_response against the continuous batching scheduler on a
+# tiny random Llama. EOS is disabled so both paths decode the same number of
+# tokens per request.
+
+
+def run_sequential(model, prompts, max_tokens):
+    started = time.perf_counter()
+    tokens = 0
+    with torch.inference_mode():
+        for prompt in prompts:
+            input_ids = torch.tensor([prompt])
+            output_ids = model.generate(
+                input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_length=input_ids.shape[1] + max_tokens,
+                min_new_tokens=max_tokens,
+                do_sample=False,
+                pad_token_id=0,
+            )
+            tokens += output_ids.shape[1] - input_ids.shape[1]
+    return tokens, time.perf_counter() - started
+
+
+def run_batched(model, prompts, max_tokens, concurrency, max_batch_size, max_batch_tokens):
+    scheduler = BatchScheduler(model, eos_token_id=None, max_batch_size=max_batch_size, max_batch_tokens=max_batch_tokens).start()
+
+    def client(prompt):
+        return len(scheduler.submit(GenerationRequest(prompt, max_tokens=max_tokens, temperature=0)).result())
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        tokens = sum(pool.map(client, prompts))
+    elapsed = time.perf_counter() - started
+    stats = scheduler.stats()
+    scheduler.stop()
+    return tokens, elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Continuous batching vs sequential generate() throughput")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--min-prompt", type=int, default=16)
+    parser.add_argument("--max-prompt", type=int, default=256)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-batch-tokens", type=int, default=16384)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model = tiny_model()
+    prompts = random_prompts(args.requests, args.min_prompt, args.max_prompt)
+
+    seq_tokens, seq_seconds = run_sequential(model, prompts, args.max_tokens)
+    batch_tokens, batch_seconds, stats = run_batched(
+        model, prompts, args.max_tokens, args.concurrency, args.max_batch_size, args.max_batch_tokens
+    )
+
+    print(f"{'path':<12}{'tokens':>10}{'seconds':>10}{'tok/s':>10}")
+    print(f"{'sequential':<12}{seq_tokens:>10}{seq_seconds:>10.2f}{seq_tokens / seq_seconds:>10.1f}")
+    print(f"{'batched':<12}{batch_tokens:>10}{batch_seconds:>10.2f}{batch_tokens / batch_seconds:>10.1f}")
+    print(f"speedup: {seq_seconds / batch_seconds:.2f}x  decode steps: {stats['steps']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import gc
+import time
+import argparse
+import multiprocessing
+from tiny import tiny_model, random_prompts
+from scheduler import BatchScheduler, GenerationRequest
+from output import configure_cpu, quantize_for_cpu
+
+# Decode throughput and resident memory of the CPU serving backend
+# (output.py --device cpu) with fp32 weights vs int8 dynamic quantization.
+# Each variant runs in its own process so RSS is not polluted by the other.
+# The default model is sized so linear layers dominate, like a real LLM.
+# Its weights are random, so logits are nearly flat and greedy outputs of
+# the two variants diverge quickly; the match count is informational only.
+
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_variant(quantize, args, results):
+    configure_cpu(args.threads)
+    baseline = rss_mb()
+    model = quantize_for_cpu(tiny_model(hidden_size=args.hidden_size, layers=args.layers, heads=args.heads), quantize)
+    gc.collect()
+    loaded = rss_mb()
+
+    prompts = random_prompts(args.requests, args.min_prompt, args.max_prompt)
+    scheduler = BatchScheduler(model, eos_token_id=None, max_batch_size=args.batch_size).start()
+    # One warm-up request so kernel selection is not timed
+    scheduler.submit(GenerationRequest(prompts[0], max_tokens=4, temperature=0)).result()
+
+    started = time.perf_counter()
+    requests = [scheduler.submit(GenerationRequest(prompt, max_tokens=args.max_tokens, temperature=0)) for prompt in prompts]
+    outputs = [request.result() for request in requests]
+    elapsed = time.perf_counter() - started
+    scheduler.stop()
+
+    results[quantize] = {
+        "tokens": sum(len(output) for output in outputs),
+        "seconds": elapsed,
+        "weights_mb": loaded - baseline,
+        "peak_rss_mb": rss_mb(),
+        "outputs": outputs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fp32 vs int8 CPU serving backend")
+    parser.add_argument("--hidden-size", type=int, default=1024)
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--heads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=1, help="1 measures single-stream latency")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--min-prompt", type=int, default=32)
+    parser.add_argument("--max-prompt", type=int, default=128)
+    parser.add_argument("--threads", type=int, default=None, help="intra-op threads (defaults to every available core)")
+    args = parser.parse_args()
+
+    results = multiprocessing.Manager().dict()
+    for quantize in ("none", "int8"):
+        process = multiprocessing.get_context("spawn").Process(target=run_variant, args=(quantize, args, results))
+        process.start()
+        process.join()
+
+    print(f"{'weights':<10}{'tokens':>10}{'seconds':>10}{'tok/s':>10}{'model MB':>12}{'RSS MB':>10}")
+    for quantize, label in (("none", "fp32"), ("int8", "int8")):
+        r = results[quantize]
+        print(f"{label:<10}{r['tokens']:>10}{r['seconds']:>10.2f}{r['tokens'] / r['seconds']:>10.1f}{r['weights_mb']:>12.0f}{r['peak_rss_mb']:>10.0f}")
+
+    fp32, int8 = results["none"], results["int8"]
+    same = sum(a == b for a, b in zip(fp32["outputs"], int8["outputs"]))
+    print(f"speedup: {fp32['seconds'] / int8['seconds']:.2f}x  "
+          f"memory: {int8['weights_mb'] / fp32['weights_mb']:.2f}x  "
+          f"greedy outputs identical to fp32: {same}/{len(fp32['outputs'])}")
+
+
+if __name__ == "__main__":
+    main()
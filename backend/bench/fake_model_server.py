@@ -0,0 +1,128 @@
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import socketserver
+
+# Stands in for `output.py --serve` on a laptop: same newline-delimited JSON
+# protocol on the same port, no torch and no GPU. Point the API at it with
+# REMOTE_BACKEND=local. Timing is synthetic: a fixed time to first token plus
+# a per-prompt-token prefill cost, then one token every `token_delay`
+# seconds, slowed down by `slowdown` for every other stream decoding at the
+# same time (a crude model of a batched GPU).
+
+WORDS = ["the", "model", "answers", "with", "a", "short", "reply", "about", "data", "training"]
+
+
+class FakeModelHandler(socketserver.StreamRequestHandler):
+    def send(self, payload):
+        line = payload if isinstance(payload, str) else json.dumps(payload)
+        self.wfile.write((line + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            if request.get("type") == "health":
+                self.send({"status": "ready", "model": "fake", "active": self.server.active})
+                continue
+
+            self.server.enter()
+            try:
+                self.complete(request)
+            finally:
+                self.server.leave()
+
+    def complete(self, request):
+        server = self.server
+        prompt_tokens = sum(len(message.get("content", "").split()) for message in request.get("messages", []))
+        max_tokens = request.get("max_tokens") or 1000
+        completion_id = "chatcmpl-" + uuid.uuid4().hex[:8]
+        created = int(time.time())
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": max_tokens, "total_tokens": prompt_tokens + max_tokens}
+
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": "fake",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+
+        time.sleep(server.ttft + server.prefill_per_token * prompt_tokens)
+        stream = request.get("stream")
+        if stream:
+            self.send(chunk({"role": "assistant", "content": ""}))
+
+        words = []
+        for i in range(max_tokens):
+            if i:
+                time.sleep(server.token_delay * (1 + server.slowdown * (server.active - 1)))
+            word = random.choice(WORDS)
+            words.append(word)
+            if stream:
+                self.send(chunk({"content": (" " if i else "") + word}))
+
+        if stream:
+            final = chunk({}, finish_reason="length")
+            final["usage"] = usage
+            self.send(final)
+            self.send("[DONE]")
+        else:
+            self.send({
+                "id": completion_id, "created": created, "model": "fake",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "length"}],
+                "usage": usage
+            })
+
+
+class FakeModelServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, ttft=0.05, prefill_per_token=0.0001, token_delay=0.01, slowdown=0.05):
+        super().__init__(address, FakeModelHandler)
+        self.ttft = ttft
+        self.prefill_per_token = prefill_per_token
+        self.token_delay = token_delay
+        self.slowdown = slowdown
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def enter(self):
+        with self.lock:
+            self.active += 1
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+
+def start(host="127.0.0.1", port=8765, **timing):
+    server = FakeModelServer((host, port), **timing)
+    threading.Thread(target=server.serve_forever, name="fake-model-server", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake output.py --serve for load testing without a GPU")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft", type=float, default=0.05, help="seconds before the first token")
+    parser.add_argument("--prefill-per-token", type=float, default=0.0001, help="extra first-token seconds per prompt word")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="seconds between tokens for a lone stream")
+    parser.add_argument("--slowdown", type=float, default=0.05, help="per-token slowdown for each other active stream")
+    args = parser.parse_args()
+
+    server = FakeModelServer(
+        (args.host, args.port), ttft=args.ttft, prefill_per_token=args.prefill_per_token,
+        token_delay=args.token_delay, slowdown=args.slowdown
+    )
+    print(json.dumps({"status": "ready", "host": args.host, "port": args.port}), flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import time
+import math
+import random
+import asyncio
+import argparse
+import subprocess
+from pathlib import Path
+import httpx
+
+# Load generator for the OpenAI-compatible /v1/chat/completions endpoint.
+#   closed  - `concurrency` clients, each sending its next request as soon
+#             as the previous one finishes
+#   poisson - open loop, arrivals at `rate` requests/second with exponential
+#             gaps, no matter how far behind the server falls
+# Prompt and output lengths are drawn from distributions written as `128`,
+# `uniform:32:512` or `lognormal:128:0.6` (median, sigma). With --fake the
+# whole serving path runs locally: bench/fake_model_server.py stands in for
+# output.py and the API is started with REMOTE_BACKEND=local.
+
+BACKEND_DIR = Path(__file__).parent.parent
+FILLER = "please summarise the following training data record in plain words".split()
+
+
+def parse_distribution(spec):
+    kind, _, params = spec.partition(":")
+    if not params:
+        value = int(kind)
+        return lambda rng: value
+    values = [float(v) for v in params.split(":")]
+    if kind == "uniform":
+        return lambda rng: rng.randint(int(values[0]), int(values[1]))
+    if kind == "lognormal":
+        return lambda rng: max(1, int(rng.lognormvariate(math.log(values[0]), values[1])))
+    raise ValueError(f"Unknown distribution: {spec}")
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def make_payload(rng, prompt_length, output_length, args):
+    words = [rng.choice(FILLER) for _ in range(prompt_length)]
+    return {
+        "model": args.model,
+        "messages": [{"role": "user", "content": " ".join(words)}],
+        "max_tokens": output_length,
+        "temperature": args.temperature,
+        "stream": args.stream,
+    }
+
+
+async def send(client, payload):
+    result = {"started": time.perf_counter(), "ttft": None, "tokens": 0, "status": None, "error": None}
+    try:
+        if payload["stream"]:
+            async with client.stream("POST", "/v1/chat/completions", json=payload) as response:
+                result["status"] = response.status_code
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: ") or line == "data: [DONE]":
+                        continue
+                    event = json.loads(line[len("data: "):])
+                    if "error" in event:
+                        result["error"] = event["error"].get("message")
+                        continue
+                    if event["choices"][0]["delta"].get("content"):
+                        if result["ttft"] is None:
+                            result["ttft"] = time.perf_counter() - result["started"]
+                        result["tokens"] += 1
+                    if event.get("usage"):
+                        result["tokens"] = event["usage"]["completion_tokens"]
+                if response.status_code != 200:
+                    result["error"] = f"HTTP {response.status_code}"
+        else:
+            response = await client.post("/v1/chat/completions", json=payload)
+            result["status"] = response.status_code
+            if response.status_code == 200:
+                result["tokens"] = response.json().get("usage", {}).get("completion_tokens", 0)
+            else:
+                result["error"] = f"HTTP {response.status_code}"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    result["latency"] = time.perf_counter() - result["started"]
+    if result["ttft"] is None and result["error"] is None:
+        # Without streaming the first token arrives with the last one
+        result["ttft"] = result["latency"]
+    return result
+
+
+async def run_closed(client, payloads, concurrency, deadline):
+    results, queue = [], list(reversed(payloads))
+
+    async def worker():
+        while queue and time.perf_counter() < deadline:
+            results.append(await send(client, queue.pop()))
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results
+
+
+async def run_poisson(client, payloads, rate, deadline, rng):
+    tasks = []
+    for payload in payloads:
+        if time.perf_counter() >= deadline:
+            break
+        tasks.append(asyncio.ensure_future(send(client, payload)))
+        await asyncio.sleep(rng.expovariate(rate))
+    return await asyncio.gather(*tasks)
+
+
+def summarize(results, elapsed):
+    ok = [r for r in results if r["error"] is None]
+    errors = {}
+    for r in results:
+        if r["error"] is not None:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok]
+    tokens = sum(r["tokens"] for r in ok)
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "requests_per_second": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "output_tokens_per_second": round(tokens / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {f"p{q}": round(1000 * percentile(latencies, q), 1) if latencies else None for q in (50, 95, 99)},
+        "ttft_ms": {f"p{q}": round(1000 * percentile(ttfts, q), 1) if ttfts else None for q in (50, 95, 99)},
+    }
+
+
+def start_fake_stack(port, args):
+    sys.path.insert(0, str(Path(__file__).parent))
+    import fake_model_server
+    fake_model_server.start(token_delay=args.fake_token_delay, ttft=args.fake_ttft)
+
+    env = {
+        **os.environ,
+        "REMOTE_BACKEND": "local",
+        "LOCAL_REMOTE_HOME": os.path.join(BACKEND_DIR, ".remote"),
+        "GROQ_API_KEY": os.environ.get("GROQ_API_KEY", "unused"),
+    }
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if api.poll() is not None:
+            raise RuntimeError("API server exited during startup")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return api
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    api.terminate()
+    raise RuntimeError("API server did not start within 60s")
+
+
+async def main_async(args):
+    rng = random.Random(args.seed)
+    prompt_lengths = parse_distribution(args.prompt_tokens)
+    output_lengths = parse_distribution(args.output_tokens)
+    payloads = [make_payload(rng, prompt_lengths(rng), output_lengths(rng), args) for _ in range(args.requests)]
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        deadline = started + args.duration if args.duration else float("inf")
+        if args.mode == "closed":
+            results = await run_closed(client, payloads, args.concurrency, deadline)
+        else:
+            results = await run_poisson(client, payloads, args.rate, deadline, rng)
+        elapsed = time.perf_counter() - started
+
+        summary = summarize(results, elapsed)
+        try:
+            summary["server_metrics"] = (await client.get("/metrics")).json()
+        except Exception:
+            pass
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /v1/chat/completions")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--mode", choices=["closed", "poisson"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=8, help="clients in closed-loop mode")
+    parser.add_argument("--rate", type=float, default=4.0, help="arrivals per second in poisson mode")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=None, help="stop sending after this many seconds")
+    parser.add_argument("--prompt-tokens", default="uniform:32:512")
+    parser.add_argument("--output-tokens", default="lognormal:128:0.6")
+    parser.add_argument("--temperature", type=float, default=0.7, help="0 makes requests cacheable by the API")
+    parser.add_argument("--stream", action="store_true", help="use SSE streaming, which measures real TTFT")
+    parser.add_argument("--model", default="runway-lora")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    parser.add_argument("--fake", action="store_true", help="start the fake model server and a local API first")
+    parser.add_argument("--fake-port", type=int, default=8011, help="API port used with --fake")
+    parser.add_argument("--fake-ttft", type=float, default=0.05)
+    parser.add_argument("--fake-token-delay", type=float, default=0.01)
+    args = parser.parse_args()
+
+    api = None
+    if args.fake:
+        api = start_fake_stack(args.fake_port, args)
+        args.url = f"http://127.0.0.1:{args.fake_port}"
+
+    try:
+        summary = asyncio.run(main_async(args))
+    finally:
+        if api is not None:
+            api.terminate()
+            api.wait()
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print(f"{args.mode} loop, {summary['requests']} requests in {summary['seconds']}s "
+          f"({summary['requests_per_second']} req/s, {summary['output_tokens_per_second']} output tok/s)")
+    print(f"error rate: {summary['error_rate']:.2%} {summary['errors'] or ''}")
+    print(f"{'':<12}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, key in (("latency ms", "latency_ms"), ("ttft ms", "ttft_ms")):
+        row = summary[key]
+        print(f"{name:<12}" + "".join(f"{str(row[p]):>10}" for p in ("p50", "p95", "p99")))
+
+
+if __name__ == "__main__":
+    main()
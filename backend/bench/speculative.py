@@ -0,0 +1,69 @@
+import time
+import argparse
+import torch
+from tiny import tiny_model, random_prompts
+from scheduler import BatchScheduler, GenerationRequest
+from speculative import SpeculativeDecoder, PromptLookupProposer, DraftModelProposer
+
+# Runs the same greedy requests one at a time through the scheduler with and
+# without speculative decoding, checks the outputs are token-for-token
+# identical, and reports acceptance rate and speedup. Weights are random, so
+# the acceptance rates only exercise the bookkeeping:
+#   ngram - prompt lookup; greedy decoding of a random model loops a lot
+#   self  - the target drafts for itself, every draft is accepted
+#   small - an independent 1-layer model, almost nothing is accepted
+
+
+def run(model, prompts, max_tokens, speculative=None):
+    scheduler = BatchScheduler(model, eos_token_id=None, speculative=speculative).start()
+    outputs = []
+    started = time.perf_counter()
+    for prompt in prompts:
+        outputs.append(scheduler.submit(GenerationRequest(prompt, max_tokens=max_tokens, temperature=0)).result())
+    elapsed = time.perf_counter() - started
+    stats = scheduler.stats()
+    scheduler.stop()
+    return outputs, elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speculative vs plain greedy decoding")
+    parser.add_argument("--proposer", choices=["ngram", "self", "small"], default="ngram")
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--min-prompt", type=int, default=16)
+    parser.add_argument("--max-prompt", type=int, default=128)
+    parser.add_argument("--num-draft", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model = tiny_model()
+    prompts = random_prompts(args.requests, args.min_prompt, args.max_prompt)
+
+    if args.proposer == "ngram":
+        proposer = PromptLookupProposer()
+    elif args.proposer == "self":
+        proposer = DraftModelProposer(model)
+    else:
+        proposer = DraftModelProposer(tiny_model(layers=1, seed=1))
+    speculative = SpeculativeDecoder(proposer, args.num_draft)
+
+    plain, plain_seconds, plain_stats = run(model, prompts, args.max_tokens)
+    fast, fast_seconds, fast_stats = run(model, prompts, args.max_tokens, speculative)
+
+    mismatched = sum(a != b for a, b in zip(plain, fast))
+    tokens = sum(len(output) for output in plain)
+    spec = fast_stats["speculative"]
+    print(f"{'path':<14}{'tokens':>10}{'passes':>10}{'seconds':>10}{'tok/s':>10}")
+    print(f"{'greedy':<14}{tokens:>10}{plain_stats['steps'] + args.requests:>10}{plain_seconds:>10.2f}{tokens / plain_seconds:>10.1f}")
+    print(f"{'speculative':<14}{tokens:>10}{fast_stats['steps'] + args.requests:>10}{fast_seconds:>10.2f}{tokens / fast_seconds:>10.1f}")
+    print(f"identical outputs: {args.requests - mismatched}/{args.requests}  "
+          f"acceptance: {spec['acceptance_rate']:.2%}  tokens/step: {spec['tokens_per_step']}  "
+          f"speedup: {plain_seconds / fast_seconds:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import sys
+import torch
+from pathlib import Path
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+# Benchmarks import the scripts that get shipped to the GPU host
+sys.path.insert(0, str(Path(__file__).parent.parent / "data"))
+
+BOS_TOKEN_ID = 256
+EOS_TOKEN_ID = 257
+
+
+def tiny_tokenizer() -> PreTrainedTokenizerFast:
+    # Byte-level vocabulary with no merges: every UTF-8 byte is one token
+    alphabet = sorted(pre_tokenizers.ByteLevel.alphabet())
+    vocab = {symbol: i for i, symbol in enumerate(alphabet)}
+    vocab["<s>"] = BOS_TOKEN_ID
+    vocab["</s>"] = EOS_TOKEN_ID
+
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        model_input_names=["input_ids", "attention_mask"],
+    )
+
+
+def tiny_model(hidden_size: int = 256, layers: int = 4, heads: int = 8, seed: int = 0) -> LlamaForCausalLM:
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=EOS_TOKEN_ID + 1,
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 4,
+        num_hidden_layers=layers,
+        num_attention_heads=heads,
+        num_key_value_heads=max(1, heads // 2),
+        max_position_embeddings=4096,
+        bos_token_id=BOS_TOKEN_ID,
+        eos_token_id=EOS_TOKEN_ID,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def random_prompts(count: int, min_length: int, max_length: int, seed: int = 0) -> list[list[int]]:
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(min_length, max_length + 1, (count,), generator=generator).tolist()
+    return [torch.randint(0, BOS_TOKEN_ID, (length,), generator=generator).tolist() for length in lengths]
@@ -0,0 +1,120 @@
+import json, time, asyncio
+from os import getenv
+from util.remote import get_remote, in_thread, SSHRemote, LocalRemote
+from util.helpers import stream_from_ssh
+
+RUNWAY_DIR = "/home/ubuntu/runway"
+MODEL_SERVER_HOST = "127.0.0.1"
+MODEL_SERVER_PORT = 8765
+MODEL_SERVER_STARTUP_TIMEOUT = 900
+
+# Extra output.py flags per serving backend. "cpu" is a GPU-less host
+# (SSH_HOST_CPU) running the merged model int8-quantized; request models
+# listed in CPU_MODELS (comma separated) are routed there. Per-request
+# adapters need no flag here: output.py takes `max_adapters` from the synced
+# config.json and otherwise serves runway/adapters/<name> whenever any exist.
+SERVER_FLAGS = {
+    "gpu": "",
+    "cpu": "--device cpu --quantize int8",
+}
+
+_startup_locks = {backend: asyncio.Lock() for backend in SERVER_FLAGS}
+
+
+def backend_for(model: str | None) -> str:
+    cpu_models = {name.strip() for name in getenv("CPU_MODELS", "").split(",") if name.strip()}
+    if model in cpu_models and getenv("SSH_HOST_CPU"):
+        return "cpu"
+    return "gpu"
+
+
+def remote_for(backend: str = "gpu") -> SSHRemote | LocalRemote:
+    return get_remote(getenv("SSH_HOST_CPU") if backend == "cpu" else getenv("SSH_HOST_H100"))
+
+
+#### MODEL SERVER SOCKET (output.py --serve)
+
+def read_line(channel) -> str:
+    buffer = b""
+    while not buffer.endswith(b"\n"):
+        chunk = channel.recv(4096)
+        if not chunk:
+            break
+        buffer += chunk
+    return buffer.decode("utf-8")
+
+
+def send_and_read(channel, payload: dict) -> str:
+    channel.sendall((json.dumps(payload) + "\n").encode("utf-8"))
+    return read_line(channel)
+
+
+async def exchange(remote: SSHRemote | LocalRemote, payload: dict) -> dict:
+    async with remote.open_channel(MODEL_SERVER_HOST, MODEL_SERVER_PORT) as channel:
+        line = await in_thread(send_and_read, channel, payload)
+
+    if not line.strip():
+        raise Exception("Model server closed the connection without responding")
+    return json.loads(line)
+
+
+async def is_ready(remote: SSHRemote | LocalRemote) -> bool:
+    try:
+        return (await exchange(remote, {"type": "health"})).get("status") == "ready"
+    except Exception:
+        return False
+
+
+async def start_model_server(remote: SSHRemote | LocalRemote, backend: str = "gpu") -> None:
+    command = (
+        f'cd {RUNWAY_DIR} && source .venv/bin/activate && '
+        f'setsid nohup python3 output.py --serve --port {MODEL_SERVER_PORT} {SERVER_FLAGS[backend]} '
+        '> model_server.log 2>&1 < /dev/null &'
+    )
+    await remote.run(command)
+
+
+async def stop_model_server(remote: SSHRemote | LocalRemote) -> None:
+    # The bracket keeps the pattern from matching this shell's own command
+    # line, which pkill would otherwise kill along with the daemon
+    await remote.run("pkill -f '[o]utput.py --serve' || true")
+
+
+async def ensure_model_server(remote: SSHRemote | LocalRemote, backend: str = "gpu", timeout: int = MODEL_SERVER_STARTUP_TIMEOUT) -> None:
+    if await is_ready(remote):
+        return
+
+    # Concurrent requests landing on a cold host should share one launch
+    async with _startup_locks[backend]:
+        if await is_ready(remote):
+            return
+
+        await start_model_server(remote, backend)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if await is_ready(remote):
+                return
+            await asyncio.sleep(2)
+
+    raise Exception(f"Model server did not become ready within {timeout}s")
+
+
+async def create_completion(request: dict) -> dict:
+    backend = backend_for(request.get("model"))
+    remote = remote_for(backend)
+    await ensure_model_server(remote, backend)
+    return await exchange(remote, request)
+
+
+async def stream_completion(request: dict):
+    try:
+        backend = backend_for(request.get("model"))
+        remote = remote_for(backend)
+        await ensure_model_server(remote, backend)
+        async with remote.open_channel(MODEL_SERVER_HOST, MODEL_SERVER_PORT) as channel:
+            async for event in stream_from_ssh(channel, request):
+                yield event
+    except Exception as e:
+        # Response headers are already out, so failures become an SSE event
+        print(e)
+        yield f"data: {json.dumps({'error': {'message': str(e), 'type': 'internal_error'}})}\n\n"
@@ -7,6 +7,7 @@ from util.dtypes import WSRequest
 from core.model_advice import model_advice_response
 from core.dataset_gen import dataset_build_response
 from core.trainer import train_model_response
+from core.warmup import start_warm_up, cancel_warm_up, wait_for_warm_up
 
 import json
 
@@ -26,6 +27,7 @@ import json
 
 async def respond(data: WSRequest, send_handler: Callable[[dict, Literal["text"]], None]) -> None:
     if(data.type == "idea_input"):
+        cancel_warm_up()
         await model_advice_response(data, send_handler)
         with open('data/config.json', 'w') as f: 
             json.dump({
@@ -39,6 +41,8 @@ async def respond(data: WSRequest, send_handler: Callable[[dict, Literal["text"]
         config["model"] = data.text
         with open('data/config.json', 'w') as f:
             json.dump(config, f, indent=4)
+        # Provision the host and fetch the weights while the dataset is built
+        start_warm_up(data.text)
     elif (data.type == "dataset_input"):
         await dataset_build_response(data, send_handler)
     elif (data.type ==  "train_instance_choice"):
@@ -49,5 +53,8 @@ async def respond(data: WSRequest, send_handler: Callable[[dict, Literal["text"]
         with open('data/config.json', 'w') as f:
             json.dump(config, f, indent=4)
     elif (data.type == "train"):
+        with open('data/config.json', 'r') as f:
+            config = json.load(f)
+        await wait_for_warm_up(config["model"], send_handler)
         await train_model_response(data, send_handler)
 
@@ -1,44 +1,163 @@
-import paramiko
+import json, hashlib, shlex
 from typing import Callable, Literal
 from util.dtypes import WSRequest
 from util.helpers import get_log_format
+from util.telemetry import TelemetryAggregator
+from pydantic import ValidationError
+from util.remote import get_remote, SSHRemote, LocalRemote
+from util.sync import sync_files, format_bytes, file_sha256
+from core.inference import stop_model_server
+from util.response_cache import response_cache
 
 from os import getenv 
-SSH_USERNAME = "ubuntu"
-SSH_HOST = getenv("SSH_HOST_H100")
 
-async def run_command(ssh: paramiko.SSHClient, command: str, send_handler: Callable[[dict, Literal["text"]], None]) -> None:
-    stdin, stdout, stderr = ssh.exec_command(command)
-
-    for line in iter(stdout.readline, ""):
+# Per-command limits, in seconds
+SETUP_TIMEOUT = 60 * 60
+TRAIN_TIMEOUT = 12 * 60 * 60
+MATERIALIZE_TIMEOUT = 30 * 60
+
+# Everything the training host needs, synced into ~/runway as name -> (local path, mode)
+TRAINING_ARTIFACTS = {
+    name: (f"data/{name}", mode) for name, mode in [
+        ("dataset.jsonl", 0o644),
+        ("config.json", 0o644),
+        ("secrets.txt", 0o600),
+        ("setup.sh", 0o755),
+        ("requirements.txt", 0o644),
+        ("run.sh", 0o755),
+        ("train_script.py", 0o644),
+        ("packing.py", 0o644),
+        ("sampler.py", 0o644),
+        ("token_cache.py", 0o644),
+        ("resume.py", 0o644),
+        ("probe.py", 0o644),
+        ("output.py", 0o644),
+        ("scheduler.py", 0o644),
+        ("prefix_cache.py", 0o644),
+        ("adapters.py", 0o644),
+        ("speculative.py", 0o644),
+        ("prefetch.py", 0o644),
+    ]
+}
+
+RUNWAY_DIR = "/home/ubuntu/runway"
+# setup.sh writes the fingerprint it was given here once the venv is complete
+ENV_MARKER = ".venv/.tuna_env"
+
+# train_script.py prints structured events as `TUNA_EVENT {json}` lines
+EVENT_PREFIX = "TUNA_EVENT "
+
+
+def event_message(event: dict) -> dict:
+    text = ""
+    if event.get("event") == "eval":
+        text = f"Epoch {event['epoch']:g}: held-out loss {event['eval_loss']:.4f}"
+    elif event.get("event") == "training_stopped":
+        if event["reason"] == "plateau":
+            text = (f"Eval loss stopped improving, so training stopped after {event['epochs']:g} of {event['max_epochs']} epochs "
+                    f"and kept the best adapter (saved ~{event['gpu_hours_saved']:.2f} GPU-hours)")
+        else:
+            text = f"Trained for all {event['max_epochs']} epochs"
+    return {
+        "type": "train_details",
+        "text": text,
+        "log": get_log_format(f"{EVENT_PREFIX}{json.dumps(event)}\n"),
+        "event": event,
+        "complete": False
+    }
+
+
+async def run_command(remote: SSHRemote | LocalRemote, command: str, send_handler: Callable[[dict, Literal["text"]], None], timeout: float | None = None, check: bool = True) -> int:
+    # Output is relayed as it arrives on either stream. A timeout or a
+    # cancelled caller (the client disconnected) kills the remote command
+    telemetry = TelemetryAggregator(send_handler)
+
+    async def relay(stream: str, line: str) -> None:
+        if stream == "stdout" and line.startswith(EVENT_PREFIX):
+            try:
+                event = json.loads(line[len(EVENT_PREFIX):])
+                if event.get("event") == "metrics":
+                    await telemetry.add(event)
+                else:
+                    await telemetry.flush()
+                    await send_handler(event_message(event))
+                return
+            except (ValueError, KeyError, ValidationError):
+                pass
+        # Keep the client's order the same as the remote's
+        await telemetry.flush()
         await send_handler({
             "type": "train_details",
             "text": "",
-            "log": get_log_format(f"{line}\n"),
+            "log": get_log_format(f"[ERROR] {line}\n" if stream == "stderr" else f"{line}\n"),
             "complete": False
         })
 
-    for line in iter(stderr.readline, ""):
+    try:
+        status = await remote.run(command, relay, timeout=timeout)
+    finally:
+        await telemetry.flush()
+    if check and status != 0:
+        raise Exception(f"`{command}` exited with status {status}")
+    return status
+
+
+#### ENVIRONMENT PROVISIONING
+#
+# The venv on the host is identified by a fingerprint of the package set
+# (requirements.txt), setup.sh itself and the host's Python version. When the
+# marker setup.sh left behind matches, the host is already provisioned and
+# setup.sh does not run at all.
+
+async def remote_environment(remote: SSHRemote | LocalRemote) -> tuple[str, str | None]:
+    # One round trip for the Python version and the current marker, if any
+    lines = []
+
+    async def collect(stream: str, line: str) -> None:
+        if stream == "stdout":
+            lines.append(line.strip())
+
+    quoted = shlex.quote(RUNWAY_DIR)
+    await remote.run(
+        f"python3 -V 2>&1 || echo none; cd {quoted} 2>/dev/null && [ -x .venv/bin/python ] && cat {ENV_MARKER} 2>/dev/null; true",
+        collect, timeout=60
+    )
+    python = lines[0] if lines else "none"
+    return python, (lines[1] if len(lines) > 1 else None)
+
+
+def environment_fingerprint(python: str) -> str:
+    digest = hashlib.sha256(python.encode())
+    for name in ("requirements.txt", "setup.sh"):
+        digest.update(file_sha256(TRAINING_ARTIFACTS[name][0]).encode())
+    return digest.hexdigest()[:16]
+
+
+async def ensure_environment(remote: SSHRemote | LocalRemote, send_handler: Callable[[dict, Literal["text"]], None]) -> bool:
+    # Returns True when provisioning was skipped
+    python, marker = await remote_environment(remote)
+    fingerprint = environment_fingerprint(python)
+    if marker == fingerprint:
         await send_handler({
             "type": "train_details",
             "text": "",
-            "log": get_log_format(f"[ERROR] {line}\n"),
+            "log": get_log_format(f"Environment {fingerprint} is already provisioned ({python}), skipping setup", tuna_msg=True),
             "complete": False
         })
-
-
-
-
-async def transfer_file(ssh: paramiko.SSHClient, source: str, destination: str, send_handler: Callable[[dict, Literal["text"]], None]) -> None:
-    sftp = ssh.open_sftp()
-    sftp.put(source, destination)
+        return True
 
     await send_handler({
         "type": "train_details",
         "text": "",
-        "log": get_log_format(f"Transferred {source} to {destination}\n"),
+        "log": get_log_format(
+            f"Provisioning environment {fingerprint} ({python})"
+            + (f", replacing {marker}" if marker else "") + "\n"
+        ),
         "complete": False
     })
+    await run_command(remote, f"cd {shlex.quote(RUNWAY_DIR)} && TUNA_ENV_FINGERPRINT={fingerprint} ./setup.sh", send_handler, timeout=SETUP_TIMEOUT)
+    return False
+
 
 
 
@@ -51,23 +170,27 @@ async def transfer_file(ssh: paramiko.SSHClient, source: str, destination: str,
 
 
 async def train_model_response(data: WSRequest, send_handler: Callable[[dict, Literal["text"]], None]) -> None:
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
     try:
-        ssh.connect(SSH_HOST, username=SSH_USERNAME)
-
-        await transfer_file(ssh, "data/dataset.jsonl", "/home/ubuntu/runway/dataset.jsonl", send_handler)
-        await transfer_file(ssh, "data/output.py", "/home/ubuntu/runway/output.py", send_handler)
-        await transfer_file(ssh, "data/setup.sh", "/home/ubuntu/runway/setup.sh", send_handler)
-        await transfer_file(ssh, "data/run.sh", "/home/ubuntu/runway/run.sh", send_handler)
-        await transfer_file(ssh, "data/secrets.txt", "/home/ubuntu/runway/secrets.txt", send_handler)
-        
-        await run_command(ssh, "cd /home/ubuntu/runway && chmod +x ./setup.sh", send_handler)
-        await run_command(ssh, "cd /home/ubuntu/runway && chmod +x ./run.sh", send_handler)
-
-        await transfer_file(ssh, "data/train_script.py", "/home/ubuntu/runway/train_script.py", send_handler)
-        await transfer_file(ssh, "data/config.json", "/home/ubuntu/runway/config.json", send_handler)
+        remote = get_remote(getenv("SSH_HOST_H100"))
+        report = await sync_files(remote, TRAINING_ARTIFACTS, RUNWAY_DIR)
+        await send_handler({
+            "type": "train_details",
+            "text": "",
+            "log": get_log_format(
+                f"Synced {len(report.sent)} of {len(TRAINING_ARTIFACTS)} files in {report.seconds:.1f}s "
+                f"({format_bytes(report.compressed_bytes)} sent, {format_bytes(report.saved_bytes)} saved)"
+                + (f": {', '.join(report.sent)}" if report.sent else "") + "\n"
+            ),
+            "sync": {
+                "sent": report.sent,
+                "unchanged": report.unchanged,
+                "total_bytes": report.total_bytes,
+                "compressed_bytes": report.compressed_bytes,
+                "saved_bytes": report.saved_bytes,
+                "seconds": round(report.seconds, 3)
+            },
+            "complete": False
+        })
 
         await send_handler({
             "type": "train_details",
@@ -76,14 +199,25 @@ async def train_model_response(data: WSRequest, send_handler: Callable[[dict, Li
             "complete": False
         })
 
-        await run_command(ssh, "cd /home/ubuntu/runway && ./setup.sh", send_handler)
+        await ensure_environment(remote, send_handler)
+        # The warm inference daemon would hold GPU memory through the
+        # micro-batch probe and training
+        await stop_model_server(remote)
         await send_handler({
             "type": "train_details",
             "text": "We're now training your model...",
             "log": get_log_format("Setup complete. Beginning training", tuna_msg=True),
             "complete": False
         })
-        await run_command(ssh, "cd /home/ubuntu/runway && ./run.sh", send_handler)
+        await run_command(remote, "cd /home/ubuntu/runway && ./run.sh", send_handler, timeout=TRAIN_TIMEOUT)
+        # Merge the new adapter once now so the inference daemon can
+        # mmap-load it instead of merging on its next start
+        await run_command(remote, "cd /home/ubuntu/runway && source .venv/bin/activate && python3 output.py --materialize", send_handler, timeout=MATERIALIZE_TIMEOUT)
+        # An inference request during training may have started the daemon
+        # again, with the previous adapter
+        await stop_model_server(remote)
+        # Cached temperature-0 answers came from the previous adapter
+        response_cache.clear()
 
         await send_handler({
             "type": "train_details",
@@ -101,6 +235,3 @@ async def train_model_response(data: WSRequest, send_handler: Callable[[dict, Li
             "complete": False
         })
 
-    finally:
-        ssh.close()
-
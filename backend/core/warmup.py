@@ -0,0 +1,115 @@
+import asyncio, shlex, time
+from typing import Callable, Literal
+from util.helpers import get_log_format
+from util.remote import get_remote
+from util.sync import sync_files
+from core.trainer import TRAINING_ARTIFACTS, RUNWAY_DIR, ensure_environment, run_command
+
+from os import getenv
+
+#### HOST WARM-UP
+#
+# The base model is known at model_choice, well before the user asks to
+# train, so the GPU host is provisioned and the model weights prefetched
+# into its HF cache in the background while the dataset is generated. The
+# train step waits for whatever is left of the warm-up and then finds
+# ensure_environment a no-op and the weights already on disk. A new model
+# choice, a new idea or a disconnect cancels the warm-up, which kills
+# whatever it is running on the host.
+
+PREFETCH_TIMEOUT = 60 * 60
+
+# Only what provisioning and the prefetch need; the dataset does not exist yet
+WARM_UP_ARTIFACTS = {name: TRAINING_ARTIFACTS[name] for name in ("secrets.txt", "setup.sh", "requirements.txt", "prefetch.py")}
+
+_warm_up: asyncio.Task | None = None
+_model: str | None = None
+_started = 0.0
+_finished = 0.0
+
+
+async def print_handler(data: dict, *args) -> None:
+    # Nobody is listening for a warm-up, so its output goes to the server log
+    if data.get("log"):
+        print(f"[WARMUP] {data['log'].rstrip()}")
+
+
+async def warm_up_host(model: str) -> None:
+    global _finished
+    try:
+        remote = get_remote(getenv("SSH_HOST_H100"))
+        await sync_files(remote, WARM_UP_ARTIFACTS, RUNWAY_DIR)
+        await ensure_environment(remote, print_handler)
+        await run_command(
+            remote,
+            f"cd {shlex.quote(RUNWAY_DIR)} && source .venv/bin/activate && python3 prefetch.py {shlex.quote(model)}",
+            print_handler, timeout=PREFETCH_TIMEOUT
+        )
+    finally:
+        _finished = time.monotonic()
+
+
+def start_warm_up(model: str) -> None:
+    global _warm_up, _model, _started
+    if _warm_up is not None and _model == model and not (_warm_up.done() and _warm_up.exception() is not None):
+        return
+    cancel_warm_up()
+    _model, _started = model, time.monotonic()
+    _warm_up = asyncio.ensure_future(warm_up_host(model))
+    # Failures are reported when the train step collects the warm-up
+    _warm_up.add_done_callback(lambda task: task.cancelled() or task.exception())
+    print(f"[WARMUP] Warming up the training host for {model}")
+
+
+def cancel_warm_up() -> None:
+    global _warm_up, _model
+    if _warm_up is not None and not _warm_up.done():
+        _warm_up.cancel()
+        print(f"[WARMUP] Cancelled warm-up for {_model}")
+    _warm_up, _model = None, None
+
+
+async def wait_for_warm_up(model: str, send_handler: Callable[[dict, Literal["text"]], None]) -> None:
+    # Never fails the train step: if the warm-up did not finish cleanly the
+    # trainer provisions and downloads the usual way
+    global _warm_up, _model
+    task, warmed_model = _warm_up, _model
+    if task is None:
+        return
+    if warmed_model != model:
+        cancel_warm_up()
+        return
+
+    if not task.done():
+        await send_handler({
+            "type": "train_details",
+            "text": "",
+            "log": get_log_format(f"Waiting for the host warm-up to finish ({time.monotonic() - _started:.0f}s in)", tuna_msg=True),
+            "complete": False
+        })
+    try:
+        await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            # The train step itself was cancelled, so the warm-up goes too
+            task.cancel()
+            raise
+        return
+    except Exception as e:
+        await send_handler({
+            "type": "train_details",
+            "text": "",
+            "log": get_log_format(f"[ERROR] Host warm-up failed, provisioning now: {e}\n"),
+            "complete": False
+        })
+        return
+    finally:
+        if task.done() and _warm_up is task:
+            _warm_up, _model = None, None
+
+    await send_handler({
+        "type": "train_details",
+        "text": "",
+        "log": get_log_format(f"Host was warmed up for {model} in {_finished - _started:.0f}s while the dataset was built", tuna_msg=True),
+        "complete": False
+    })
@@ -0,0 +1,114 @@
+import os
+import time
+from collections import OrderedDict
+from peft import PeftModel
+
+#### MULTI-ADAPTER SERVING
+#
+# One fp16 base model stays resident and LoRA adapters are attached to it
+# unmerged. The adapter for a request is picked from the request's `model`
+# field: a directory of that name under ADAPTERS_DIR, otherwise the default
+# adapter trained into runway_lora. Rows in the same batch can use different
+# adapters through PEFT's per-row `adapter_names` forward argument. Adapters
+# are loaded on first use and the least recently used unpinned one is
+# deleted once more than `max_resident` are loaded.
+#
+# output.py --serve turns this on with --max-adapters, `max_adapters` in
+# config.json, or by itself when ADAPTERS_DIR (runway/adapters) contains at
+# least one adapter directory when the daemon starts.
+
+DEFAULT_ADAPTER = "default"
+BASE_ADAPTER = "__base__"
+
+
+class AdapterRegistry:
+    def __init__(self, base_model, adapters_dir, default_path, max_resident=8):
+        self.adapters_dir = adapters_dir
+        self.default_path = default_path
+        self.max_resident = max_resident
+
+        started = time.monotonic()
+        self.model = PeftModel.from_pretrained(base_model, default_path, adapter_name=DEFAULT_ADAPTER)
+        self.model.eval()
+
+        # name -> number of in-flight sequences using it, in LRU order
+        self.resident = OrderedDict({DEFAULT_ADAPTER: 0})
+        self.loads = 1
+        self.evictions = 0
+        self.load_seconds = time.monotonic() - started
+        self.evict_seconds = 0.0
+
+    def is_adapter(self, name):
+        # `model` comes straight from the client, so it may only name a
+        # directory directly inside adapters_dir: no separators, no `..`, and
+        # no symlink pointing out of it
+        if not isinstance(name, str) or name in (".", "..") or os.path.basename(name) != name or "\\" in name or "\0" in name:
+            return False
+        root = os.path.realpath(self.adapters_dir)
+        path = os.path.realpath(os.path.join(root, name))
+        if os.path.dirname(path) != root:
+            return False
+        return os.path.isfile(os.path.join(path, "adapter_config.json"))
+
+    def resolve(self, requested):
+        if requested and requested not in (DEFAULT_ADAPTER, BASE_ADAPTER) and self.is_adapter(requested):
+            return requested
+        if requested == BASE_ADAPTER:
+            return BASE_ADAPTER
+        return DEFAULT_ADAPTER
+
+    def path_for(self, name):
+        if name == DEFAULT_ADAPTER:
+            return self.default_path
+        return os.path.join(self.adapters_dir, name)
+
+    def load(self, name):
+        started = time.monotonic()
+        self.model.load_adapter(self.path_for(name), adapter_name=name)
+        self.model.eval()
+        self.load_seconds += time.monotonic() - started
+        self.loads += 1
+        self.resident[name] = 0
+
+    def evict(self):
+        while len(self.resident) > self.max_resident:
+            victim = next((name for name, pins in self.resident.items() if pins == 0), None)
+            if victim is None:
+                # Everything is in use; run over the limit rather than stall
+                return
+
+            started = time.monotonic()
+            self.model.delete_adapter(victim)
+            del self.resident[victim]
+            self.evict_seconds += time.monotonic() - started
+            self.evictions += 1
+
+    def acquire(self, requested):
+        # Only called from the scheduler thread, between forward passes
+        name = self.resolve(requested)
+        if name == BASE_ADAPTER:
+            return name
+        if name not in self.resident:
+            self.load(name)
+
+        self.resident[name] += 1
+        self.resident.move_to_end(name)
+        # Evict after pinning so the adapter just loaded is never the victim
+        self.evict()
+        return name
+
+    def release(self, name):
+        if name in self.resident and self.resident[name] > 0:
+            self.resident[name] -= 1
+
+    def stats(self):
+        return {
+            "resident": list(self.resident.keys()),
+            "resident_count": len(self.resident),
+            "max_resident": self.max_resident,
+            "in_use": {name: pins for name, pins in self.resident.items() if pins},
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "avg_load_ms": round(1000 * self.load_seconds / self.loads, 2) if self.loads else 0.0,
+            "avg_evict_ms": round(1000 * self.evict_seconds / self.evictions, 2) if self.evictions else 0.0,
+        }
@@ -1,9 +1,22 @@
+import os
 import sys
 import json
+import time
+import shutil
+import hashlib
+import uuid
 import torch
 import logging
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import argparse
+import socketserver
+from functools import partial
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
 from peft import PeftModel
+from scheduler import BatchScheduler, GenerationRequest
+from prefix_cache import PrefixCache
+from adapters import AdapterRegistry
+from speculative import SpeculativeDecoder, PromptLookupProposer, DraftModelProposer
 from datetime import datetime
 
 # Basic logging setup
@@ -17,27 +30,160 @@ from datetime import datetime
 # )
 #logger = logging.get#logger(__name__)
 
-with open("/home/ubuntu/runway/config.json", "r") as js:
-    config = json.load(js)
+# Overridden when the API runs against a local stand-in for the GPU host
+RUNWAY_DIR = os.environ.get("RUNWAY_DIR", "/home/ubuntu/runway")
+CONFIG_PATH = os.path.join(RUNWAY_DIR, "config.json")
+ADAPTER_PATH = os.path.join(RUNWAY_DIR, "runway_lora")
+# Extra LoRA adapters selectable per request, one directory per adapter
+# (adapters/<name>/adapter_config.json + weights, e.g. a copy of an earlier
+# runway_lora). A request whose `model` is <name> is served by that adapter
+ADAPTERS_DIR = os.path.join(RUNWAY_DIR, "adapters")
+# Adapters kept loaded at once when the registry turns itself on
+DEFAULT_MAX_ADAPTERS = 8
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+# The prompt is a plain transcript, so a new role marker means the model has
+# finished its turn and started writing the next one itself
+DEFAULT_STOP = ["\nUser:", "\nSystem:", "\nAssistant:"]
 
-MODEL = config["model"]
 
-def load_model():
+def load_config():
+    with open(CONFIG_PATH, "r") as js:
+        return json.load(js)
+
+def log(msg):
+    # stdout carries responses in single-shot mode, so diagnostics go to stderr
+    print(msg, file=sys.stderr, flush=True)
+
+
+#### MERGED MODEL ARTIFACT
+#
+# Merging the adapter into the base weights is deterministic, so it is done
+# once and written next to the adapter as sharded safetensors together with
+# a fingerprint of base + adapter. Later starts load that directory directly
+# (safetensors are memory-mapped) and only merge again when either side of
+# the fingerprint has changed.
+
+MERGED_PATH = os.path.join(RUNWAY_DIR, "runway_lora_merged")
+MERGED_MANIFEST = "materialize.json"
+
+def base_model_fingerprint(model_name):
+    if os.path.isdir(model_name):
+        entries = sorted(
+            (name, os.path.getsize(os.path.join(model_name, name)), int(os.path.getmtime(os.path.join(model_name, name))))
+            for name in os.listdir(model_name)
+            if os.path.isfile(os.path.join(model_name, name))
+        )
+        return json.dumps(entries)
+    # Hub snapshots are content addressed, so the resolved commit stands in
+    # for hashing several GB of base weights on every start
+    return f"{model_name}@{getattr(AutoConfig.from_pretrained(model_name), '_commit_hash', None)}"
+
+def adapter_fingerprint(adapter_path):
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(adapter_path)):
+        path = os.path.join(adapter_path, name)
+        if not os.path.isfile(path):
+            continue
+        digest.update(name.encode("utf-8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+def merged_fingerprint(model_name):
+    digest = hashlib.sha256()
+    digest.update(base_model_fingerprint(model_name).encode("utf-8"))
+    digest.update(adapter_fingerprint(ADAPTER_PATH).encode("utf-8"))
+    return digest.hexdigest()
+
+def read_merged_manifest():
+    try:
+        with open(os.path.join(MERGED_PATH, MERGED_MANIFEST), "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+#### DEVICE PLACEMENT
+#
+# "gpu" is the H100 path: fp16 weights placed by accelerate. "cpu" serves
+# low-traffic models on a GPU-less host: weights load in fp32 (CPUs have no
+# fast fp16 matmul) and every nn.Linear can then be swapped for an int8
+# dynamically quantized one, which stores a quarter of the bytes and runs
+# through the int8 GEMM kernels on all cores.
+
+def load_kwargs(device):
+    if device == "cpu":
+        return {"torch_dtype": torch.float32}
+    return {"torch_dtype": torch.float16, "device_map": "auto"}
+
+def configure_cpu(threads=None):
+    # Decode is one long chain of matmuls, so all cores go to intra-op
+    # parallelism rather than running independent ops side by side
+    threads = threads or len(os.sched_getaffinity(0))
+    torch.set_num_threads(threads)
+    log(f"CPU inference on {threads} threads")
+
+def quantize_for_cpu(model, quantize):
+    if quantize == "int8":
+        started = time.time()
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        log(f"Quantized linear layers to int8 in {time.time() - started:.1f}s")
+    return model.eval()
+
+def load_base_model(model_name, device="gpu"):
     #logger.info("Loading base model: meta-llama/Llama-3.1-8B")
-    base_model = AutoModelForCausalLM.from_pretrained(
-        MODEL,
-        torch_dtype=torch.float16,
-        device_map="auto"
-    )
+    return AutoModelForCausalLM.from_pretrained(model_name, **load_kwargs(device))
+
+def merge_model(model_name, device="gpu"):
+    base_model = load_base_model(model_name, device)
     #logger.info("Loading LoRA adapter from /home/ubuntu/runway/runway_lora")
     model = PeftModel.from_pretrained(
         base_model,
-        "/home/ubuntu/runway/runway_lora",
+        ADAPTER_PATH,
         adapter_name="default"
     )
     #logger.info("Merging and unloading model")
     model = model.merge_and_unload()
-    tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-3.1-8B")
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    return model, tokenizer
+
+def materialize(model_name, fingerprint=None, device="gpu"):
+    fingerprint = fingerprint or merged_fingerprint(model_name)
+    started = time.time()
+    model, tokenizer = merge_model(model_name, device)
+
+    # Written to a scratch directory and swapped in, so a crash mid-write
+    # never leaves a half-written artifact that matches the fingerprint
+    staging = MERGED_PATH + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    model.save_pretrained(staging, safe_serialization=True, max_shard_size="2GB")
+    tokenizer.save_pretrained(staging)
+    with open(os.path.join(staging, MERGED_MANIFEST), "w") as f:
+        json.dump({
+            "fingerprint": fingerprint,
+            "base_model": model_name,
+            "adapter": ADAPTER_PATH,
+            "created": int(time.time())
+        }, f, indent=4)
+
+    shutil.rmtree(MERGED_PATH, ignore_errors=True)
+    os.replace(staging, MERGED_PATH)
+    log(f"Materialized merged model to {MERGED_PATH} in {time.time() - started:.1f}s")
+    return model, tokenizer
+
+def load_model(model_name, device="gpu"):
+    started = time.time()
+    fingerprint = merged_fingerprint(model_name)
+    manifest = read_merged_manifest()
+
+    if manifest and manifest.get("fingerprint") == fingerprint:
+        model = AutoModelForCausalLM.from_pretrained(MERGED_PATH, **load_kwargs(device))
+        tokenizer = AutoTokenizer.from_pretrained(MERGED_PATH)
+        log(f"Loaded materialized model from {MERGED_PATH} in {time.time() - started:.1f}s")
+    else:
+        log("Merged model missing or stale, merging adapter")
+        model, tokenizer = materialize(model_name, fingerprint, device)
     #logger.info("Model loading complete")
     return model, tokenizer
 
@@ -50,77 +196,478 @@ def format_chat_prompt(messages):
     prompt += "Assistant: "
     return prompt
 
-def generate_response(model, tokenizer, messages, max_tokens=1000, temperature=0.7, top_p=0.9):
+class IncrementalDetokenizer:
+    # Decodes one token at a time without re-decoding the whole sequence.
+    # Text is only released once it no longer ends in a partial UTF-8
+    # character, and decoding restarts from the previous token so that
+    # tokenizers which merge leading spaces still produce the right delta.
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def decode(self, token_ids):
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True)
+
+    def push(self, token_id):
+        self.token_ids.append(token_id)
+        prefix_text = self.decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self.decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+    def flush(self):
+        prefix_text = self.decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self.decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class ChunkStreamer(BaseStreamer):
+    # generate() hands the prompt to put() first, then every new token
+    def __init__(self, tokenizer, on_text):
+        self.detokenizer = IncrementalDetokenizer(tokenizer)
+        self.on_text = on_text
+        self.prompt_seen = False
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+
+        for token_id in value.reshape(-1).tolist():
+            text = self.detokenizer.push(token_id)
+            if text:
+                self.on_text(text)
+
+    def end(self):
+        text = self.detokenizer.flush()
+        if text:
+            self.on_text(text)
+
+
+#### STOP SEQUENCES
+#
+# Stop strings are matched on decoded text, since a marker like "\nUser:" can
+# be split across tokens in many ways. StopSequences releases text only once
+# it cannot be the start of a stop string, so a streamed reply never shows
+# half of a marker, and cuts the reply right before the first full one.
+
+def stop_sequences(request):
+    stop = request.get("stop") or []
+    if isinstance(stop, str):
+        stop = [stop]
+    return DEFAULT_STOP + [s for s in stop if s and s not in DEFAULT_STOP]
+
+class StopSequences:
+    def __init__(self, stops):
+        self.stops = stops
+        self.pending = ""
+        self.stopped = False
+
+    def feed(self, text):
+        if self.stopped or not text:
+            return ""
+        self.pending += text
+
+        # pending never holds a complete stop string from an earlier call
+        found = [index for index in (self.pending.find(stop) for stop in self.stops) if index != -1]
+        if found:
+            self.stopped = True
+            released, self.pending = self.pending[:min(found)], ""
+            return released
+
+        hold = 0
+        for stop in self.stops:
+            for size in range(min(len(stop) - 1, len(self.pending)), hold, -1):
+                if self.pending.endswith(stop[:size]):
+                    hold = size
+                    break
+        released = self.pending[:len(self.pending) - hold]
+        self.pending = self.pending[len(self.pending) - hold:]
+        return released
+
+    def flush(self):
+        released, self.pending = ("" if self.stopped else self.pending), ""
+        return released
+
+class TokenStopper:
+    # Token id -> "stop now?", used as the scheduler's stopping callback
+    def __init__(self, tokenizer, stops):
+        self.detokenizer = IncrementalDetokenizer(tokenizer)
+        self.stops = StopSequences(stops)
+
+    def __call__(self, token_id):
+        self.stops.feed(self.detokenizer.push(token_id))
+        return self.stops.stopped
+
+class StopSequenceCriteria(StoppingCriteria):
+    # The same check for model.generate(), which passes the whole sequence
+    def __init__(self, tokenizer, stops, prompt_length):
+        self.stopper = TokenStopper(tokenizer, stops)
+        self.seen = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        for token_id in input_ids[0, self.seen:].tolist():
+            self.stopper(token_id)
+        self.seen = input_ids.shape[1]
+        return torch.full((input_ids.shape[0],), self.stopper.stops.stopped, dtype=torch.bool, device=input_ids.device)
+
+def completion_result(text, prompt_tokens, completion_tokens, finish_reason):
+    return {
+        "text": text.strip(),
+        "finish_reason": finish_reason,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+
+def generate_response(model, tokenizer, messages, max_tokens=1000, temperature=0.7, top_p=0.9, on_text=None, stop=DEFAULT_STOP):
     prompt = format_chat_prompt(messages)
     inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    prompt_length = inputs.input_ids.shape[1]
+
+    stops = StopSequences(stop)
+    parts = []
+    def release(text):
+        if text:
+            parts.append(text)
+            if on_text:
+                on_text(text)
+
+    criteria = StopSequenceCriteria(tokenizer, stop, prompt_length)
     output_ids = model.generate(
         **inputs,
-        max_length=inputs.input_ids.shape[1] + max_tokens,
+        max_length=prompt_length + max_tokens,
         temperature=temperature,
         top_p=top_p,
-        pad_token_id=tokenizer.eos_token_id
+        pad_token_id=tokenizer.eos_token_id,
+        stopping_criteria=StoppingCriteriaList([criteria]),
+        streamer=ChunkStreamer(tokenizer, lambda text: release(stops.feed(text)))
     )
-    full_text = tokenizer.decode(output_ids[0], skip_special_tokens=True)
-    # Remove the prompt from the generated text
-    response_text = full_text[len(prompt):].strip()
-    return response_text
-
-#logger.info("Loading model...")
-model, tokenizer = load_model()
-#logger.info("Model server ready to process requests")
-
-# Read the entire JSON request from standard input
-input_str = sys.stdin.read()
-if not input_str:
-    #logger.error("No input received.")
-    sys.exit(1)
-
-try:
-    request = json.loads(input_str)
-    messages = request.get("messages", [])
-    max_tokens = request.get("max_tokens", 1000)
-    temperature = request.get("temperature", 0.7)
-    top_p = request.get("top_p", 0.9)
-    
-    #logger.info("Generating response...")
-    response_text = generate_response(model, tokenizer, messages, max_tokens, temperature, top_p)
-    assistant_marker = "Assistant:"
-    last_index = response_text.rfind(assistant_marker)
-    if last_index != -1:
-        # Slice the string right after the last occurrence of the marker
-        result = response_text[last_index + len(assistant_marker):].strip()
-    else:
-        result = response_text
-
-    #logger.info(f"Response generated: {response_text}")
-    
-    # Build the full response in one go
-    response = {
-        "id": "chatcmpl-" + str(hash(response_text))[:8],
-        "created": int(datetime.now().timestamp()),
-        "model": "runway-lora",
-        "choices": [{
-            "index": 0,
-            "message": {
-                "role": "assistant",
-                "content": response_text
-            },
-            "finish_reason": "stop"
-        }],
-        "usage": {
-            "prompt_tokens": -1,
-            "completion_tokens": -1,
-            "total_tokens": -1
-        }
-    }
-    #logger.info("Response ready to send", response)
-    print(json.dumps(response), flush=True)
-except Exception as e:
-    #logger.error(f"Error processing request: {str(e)}", exc_info=True)
-    error_response = {
+    release(stops.flush())
+
+    generated = output_ids[0, prompt_length:].tolist()
+    stopped = criteria.stopper.stops.stopped or (generated and generated[-1] == tokenizer.eos_token_id)
+    return completion_result(
+        "".join(parts), prompt_length, len(generated),
+        "stop" if stopped or len(generated) < max_tokens else "length"
+    )
+
+def generate_batched(scheduler, tokenizer, messages, max_tokens=1000, temperature=0.7, top_p=0.9, on_text=None, stop=DEFAULT_STOP, adapter=None):
+    prompt = format_chat_prompt(messages)
+    request = scheduler.submit(GenerationRequest(
+        tokenizer(prompt).input_ids,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        top_p=top_p,
+        adapter=adapter,
+        stopping=TokenStopper(tokenizer, stop)
+    ))
+
+    # Detokenize on the connection thread, not the scheduler thread, which
+    # only decodes as far as it needs to spot a stop string
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    stops = StopSequences(stop)
+    parts = []
+    def release(text):
+        if text:
+            parts.append(text)
+            if on_text:
+                on_text(text)
+
+    try:
+        for token_id in request.stream():
+            release(stops.feed(detokenizer.push(token_id)))
+        release(stops.feed(detokenizer.flush()))
+        release(stops.flush())
+    except BaseException:
+        # Usually on_text failing because the client disconnected; stop
+        # decoding for it and give its batch slot back
+        request.cancel()
+        raise
+
+    if request.error is not None:
+        raise request.error
+    return completion_result("".join(parts), len(request.prompt_ids), len(request.generated), request.finish_reason)
+
+def error_response(e):
+    return {
         "error": {
             "message": str(e),
             "type": "internal_error"
         }
     }
-    print(json.dumps(error_response), flush=True)
+
+def completion_chunk(completion_id, created, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": "runway-lora",
+        "choices": [{
+            "index": 0,
+            "delta": delta,
+            "finish_reason": finish_reason
+        }]
+    }
+
+# What writing to a connection whose client went away raises
+CLIENT_GONE = (BrokenPipeError, ConnectionResetError)
+
+def stream_request(generate, request, send):
+    completion_id = "chatcmpl-" + uuid.uuid4().hex[:8]
+    created = int(datetime.now().timestamp())
+    try:
+        messages = request.get("messages", [])
+        max_tokens = request.get("max_tokens", 1000)
+        temperature = request.get("temperature", 0.7)
+        top_p = request.get("top_p", 0.9)
+
+        send(completion_chunk(completion_id, created, {"role": "assistant", "content": ""}))
+        result = generate(
+            messages, max_tokens, temperature, top_p,
+            on_text=lambda text: send(completion_chunk(completion_id, created, {"content": text})),
+            stop=stop_sequences(request)
+        )
+        chunk = completion_chunk(completion_id, created, {}, finish_reason=result["finish_reason"])
+        chunk["usage"] = result["usage"]
+        send(chunk)
+    except CLIENT_GONE:
+        raise
+    except Exception as e:
+        send(error_response(e))
+
+def handle_request(generate, request):
+    try:
+        messages = request.get("messages", [])
+        max_tokens = request.get("max_tokens", 1000)
+        temperature = request.get("temperature", 0.7)
+        top_p = request.get("top_p", 0.9)
+
+        #logger.info("Generating response...")
+        result = generate(messages, max_tokens, temperature, top_p, stop=stop_sequences(request))
+        response_text = result["text"]
+
+        #logger.info(f"Response generated: {response_text}")
+
+        # Build the full response in one go
+        return {
+            "id": "chatcmpl-" + str(hash(response_text))[:8],
+            "created": int(datetime.now().timestamp()),
+            "model": "runway-lora",
+            "choices": [{
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": response_text
+                },
+                "finish_reason": result["finish_reason"]
+            }],
+            "usage": result["usage"]
+        }
+    except Exception as e:
+        #logger.error(f"Error processing request: {str(e)}", exc_info=True)
+        return error_response(e)
+
+
+#### LONG-LIVED SERVER MODE
+#
+# Protocol: newline-delimited JSON over a TCP socket bound to localhost. Every
+# line sent by the client is one request and gets exactly one line back. A
+# request of {"type": "health"} reports readiness, anything else is treated
+# as a chat completion request. Requests with "stream": true instead get one
+# chat.completion.chunk per line as tokens are decoded, terminated by a bare
+# [DONE] line. The API server reaches this socket through an SSH direct-tcpip
+# channel, so it never has to be exposed publicly.
+
+STREAM_DONE = "[DONE]"
+
+class ModelRequestHandler(socketserver.StreamRequestHandler):
+    def send(self, payload):
+        line = payload if isinstance(payload, str) else json.dumps(payload)
+        self.wfile.write((line + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                self.send(error_response(e))
+                continue
+
+            try:
+                if request.get("stream") and request.get("type") != "health":
+                    self.server.stream(request, self.send)
+                    self.send(STREAM_DONE)
+                else:
+                    self.send(self.server.dispatch(request))
+            except CLIENT_GONE:
+                return
+
+
+class ModelServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, scheduler, tokenizer, model_name):
+        super().__init__(address, ModelRequestHandler)
+        # Connection threads only submit work; the scheduler thread owns the
+        # model and decodes every in-flight request in one shared batch
+        self.scheduler = scheduler
+        self.generate = partial(generate_batched, scheduler, tokenizer)
+        self.model_name = model_name
+        self.started = time.time()
+        self.served = 0
+
+    def dispatch(self, request):
+        if request.get("type") == "health":
+            return {
+                "status": "ready",
+                "model": self.model_name,
+                "uptime": round(time.time() - self.started, 2),
+                "served": self.served,
+                "scheduler": self.scheduler.stats()
+            }
+
+        # `model` picks the LoRA adapter when serving several of them
+        response = handle_request(partial(self.generate, adapter=request.get("model")), request)
+        self.served += 1
+        return response
+
+    def stream(self, request, send):
+        stream_request(partial(self.generate, adapter=request.get("model")), request, send)
+        self.served += 1
+
+
+def load_speculative(config, mode, num_draft, device="gpu"):
+    # config.json: "speculative": "ngram" | "draft" (off when absent), and
+    # "draft_model" naming a small model that shares the target's tokenizer
+    mode = mode or config.get("speculative") or "off"
+    if mode == "ngram":
+        return SpeculativeDecoder(PromptLookupProposer(), num_draft)
+    if mode == "draft":
+        if not config.get("draft_model"):
+            raise ValueError("speculative mode 'draft' needs draft_model in config.json")
+        draft = AutoModelForCausalLM.from_pretrained(config["draft_model"], **load_kwargs(device))
+        return SpeculativeDecoder(DraftModelProposer(draft.eval()), num_draft)
+    return None
+
+def installed_adapters():
+    if not os.path.isdir(ADAPTERS_DIR):
+        return []
+    return sorted(
+        name for name in os.listdir(ADAPTERS_DIR)
+        if os.path.isfile(os.path.join(ADAPTERS_DIR, name, "adapter_config.json"))
+    )
+
+
+def resolve_max_adapters(config, requested):
+    # --max-adapters, then `max_adapters` in config.json. Otherwise the
+    # registry is on whenever ADAPTERS_DIR holds an adapter, since they
+    # could not be selected at all with the merged model
+    if requested is not None:
+        return requested
+    if config.get("max_adapters") is not None:
+        return int(config["max_adapters"])
+    return DEFAULT_MAX_ADAPTERS if installed_adapters() else 0
+
+
+def serve(host, port, max_batch_size, max_batch_tokens, prefix_cache_mb, max_adapters=None, speculative=None, num_draft=4, device="gpu", quantize="int8", threads=None):
+    config = load_config()
+    #logger.info("Loading model...")
+    if device == "cpu":
+        configure_cpu(threads)
+
+    adapters = None
+    max_adapters = resolve_max_adapters(config, max_adapters)
+    if max_adapters > 0:
+        # Base stays unmerged so any number of adapters can share it. PEFT
+        # cannot wrap quantized linears, so this mode is never quantized
+        tokenizer = AutoTokenizer.from_pretrained(config["model"])
+        adapters = AdapterRegistry(load_base_model(config["model"], device), ADAPTERS_DIR, ADAPTER_PATH, max_adapters)
+        model = adapters.model
+    else:
+        model, tokenizer = load_model(config["model"], device)
+        if device == "cpu":
+            model = quantize_for_cpu(model, quantize)
+
+    scheduler = BatchScheduler(
+        model,
+        eos_token_id=tokenizer.eos_token_id,
+        max_batch_size=max_batch_size,
+        max_batch_tokens=max_batch_tokens,
+        prefix_cache=PrefixCache(prefix_cache_mb * 1024 * 1024) if prefix_cache_mb > 0 else None,
+        adapters=adapters,
+        speculative=load_speculative(config, speculative, num_draft, device)
+    ).start()
+
+    with ModelServer((host, port), scheduler, tokenizer, config["model"]) as server:
+        #logger.info("Model server ready to process requests")
+        print(json.dumps({"status": "ready", "host": host, "port": port, "device": device}), flush=True)
+        server.serve_forever()
+
+
+def run_once(device="gpu", quantize="int8", threads=None):
+    config = load_config()
+    #logger.info("Loading model...")
+    if device == "cpu":
+        configure_cpu(threads)
+    model, tokenizer = load_model(config["model"], device)
+    if device == "cpu":
+        model = quantize_for_cpu(model, quantize)
+
+    # Read the entire JSON request from standard input
+    input_str = sys.stdin.read()
+    if not input_str:
+        #logger.error("No input received.")
+        sys.exit(1)
+
+    try:
+        request = json.loads(input_str)
+    except json.JSONDecodeError as e:
+        print(json.dumps(error_response(e)), flush=True)
+        return
+
+    print(json.dumps(handle_request(partial(generate_response, model, tokenizer), request)), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the fine-tuned runway model")
+    parser.add_argument("--serve", action="store_true", help="load the model once and keep serving requests over a socket")
+    parser.add_argument("--materialize", action="store_true", help="merge the adapter into the base model and save it, then exit")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--max-batch-size", type=int, default=8, help="most sequences decoded together in one step")
+    parser.add_argument("--max-batch-tokens", type=int, default=16384, help="prompt + max_tokens budget across the running batch")
+    parser.add_argument("--prefix-cache-mb", type=int, default=2048, help="memory cap for reusable prompt key/values, 0 disables")
+    parser.add_argument("--max-adapters", type=int, default=None, help="serve unmerged LoRA adapters from adapters/<name>, picked per request by `model`, keeping at most this many loaded; 0 serves the merged runway_lora (defaults to `max_adapters` in config.json, else on when adapters/ has any)")
+    parser.add_argument("--speculative", choices=["off", "ngram", "draft"], help="speculative decoding for lone greedy requests (defaults to `speculative` in config.json)")
+    parser.add_argument("--num-draft", type=int, default=4, help="tokens proposed per speculative step")
+    parser.add_argument("--device", choices=["gpu", "cpu"], default="gpu", help="cpu serves the merged model without a GPU")
+    parser.add_argument("--quantize", choices=["int8", "none"], default="int8", help="weight format for --device cpu")
+    parser.add_argument("--threads", type=int, default=None, help="intra-op threads for --device cpu (defaults to every available core)")
+    args = parser.parse_args()
+
+    if args.materialize:
+        materialize(load_config()["model"], device=args.device)
+    elif args.serve:
+        serve(
+            args.host, args.port, args.max_batch_size, args.max_batch_tokens, args.prefix_cache_mb, args.max_adapters,
+            args.speculative, args.num_draft, args.device, args.quantize, args.threads
+        )
+    else:
+        run_once(args.device, args.quantize, args.threads)
@@ -0,0 +1,75 @@
+import torch
+from datasets import Dataset
+
+#### SEQUENCE PACKING
+#
+# Short input/output examples are concatenated (each followed by EOS) into
+# blocks of up to `block_size` tokens, so every step trains on a full block
+# instead of one short example. Examples are never split across blocks. The
+# collator keeps examples from seeing each other: attention is block-diagonal
+# causal (passed to the model as a 4D additive mask), position ids restart at
+# 0 for every example, and the first token of each example is not a label,
+# so nothing is trained to predict one example from the end of another.
+
+
+def pack_examples(sequences, block_size, eos_token_id):
+    blocks, lengths = [], []
+    current, current_lengths = [], []
+    for input_ids in sequences:
+        input_ids = list(input_ids)
+        if not input_ids or input_ids[-1] != eos_token_id:
+            input_ids.append(eos_token_id)
+        input_ids = input_ids[:block_size]
+
+        if len(current) + len(input_ids) > block_size:
+            blocks.append(current)
+            lengths.append(current_lengths)
+            current, current_lengths = [], []
+        current.extend(input_ids)
+        current_lengths.append(len(input_ids))
+
+    if current:
+        blocks.append(current)
+        lengths.append(current_lengths)
+    return Dataset.from_dict({"input_ids": blocks, "lengths": lengths})
+
+
+class PackedCollator:
+    def __init__(self, pad_token_id, dtype=torch.float16):
+        self.pad_token_id = pad_token_id
+        # The 4D mask is added to attention scores as-is, so it has to be in
+        # the dtype the model computes attention in
+        self.dtype = dtype
+
+    def __call__(self, features):
+        width = max(len(feature["input_ids"]) for feature in features)
+        batch = len(features)
+        input_ids = torch.full((batch, width), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch, width), -100, dtype=torch.long)
+        position_ids = torch.zeros((batch, width), dtype=torch.long)
+        # Padding gets its own segment (-1) per position so no row is fully masked
+        segments = -torch.arange(1, width + 1).repeat(batch, 1)
+
+        for row, feature in enumerate(features):
+            ids = torch.as_tensor(feature["input_ids"], dtype=torch.long)
+            input_ids[row, :len(ids)] = ids
+            labels[row, :len(ids)] = ids
+            start = 0
+            for segment, length in enumerate(feature["lengths"]):
+                length = int(length)
+                position_ids[row, start:start + length] = torch.arange(length)
+                segments[row, start:start + length] = segment
+                labels[row, start] = -100
+                start += length
+
+        causal = torch.ones((width, width), dtype=torch.bool).tril()
+        allowed = (segments.unsqueeze(2) == segments.unsqueeze(1)) & causal
+        attention_mask = torch.zeros((batch, 1, width, width), dtype=self.dtype)
+        attention_mask.masked_fill_(~allowed.unsqueeze(1), torch.finfo(self.dtype).min)
+
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "attention_mask": attention_mask,
+        }
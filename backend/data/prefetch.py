@@ -0,0 +1,33 @@
+import os
+import sys
+import time
+from huggingface_hub import HfApi, login, snapshot_download
+
+#### BASE MODEL PREFETCH
+#
+# Run by the API's warm-up as soon as the base model is chosen, while the
+# dataset is still being generated. Downloads the model into the default HF
+# cache, which is where from_pretrained in train_script.py and output.py
+# looks first, so training starts without the download. Only the files
+# from_pretrained loads are fetched: safetensors when the repo has them,
+# and never the original/ checkpoints some repos ship alongside.
+
+RUNWAY_DIR = os.environ.get("RUNWAY_DIR", "/home/ubuntu/runway")
+SKIPPED = ["original/*", "*.pth", "*.gguf", "*.onnx", "*.msgpack", "*.h5", "*.ot"]
+
+
+def main(model_name):
+    with open(os.path.join(RUNWAY_DIR, "secrets.txt"), "r") as f:
+        login(token=f.read().strip())
+
+    files = HfApi().list_repo_files(model_name)
+    ignore = SKIPPED + (["*.bin"] if any(name.endswith(".safetensors") for name in files) else [])
+
+    started = time.time()
+    path = snapshot_download(model_name, ignore_patterns=ignore)
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    print(f"Prefetched {model_name} ({size / 2**30:.1f} GB) in {time.time() - started:.1f}s", flush=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
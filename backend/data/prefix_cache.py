@@ -0,0 +1,175 @@
+import time
+import torch
+
+#### PREFIX KV CACHE
+#
+# A radix tree over token ids. Each node owns the key/value tensors for the
+# run of tokens on its edge, so the cached state for any prefix is the
+# concatenation of the nodes along its path. Because attention is causal
+# those tensors stay valid no matter what comes after the prefix, which lets
+# a request that shares a system prompt or earlier turns with a previous one
+# prefill only its new suffix. Leaves are evicted least-recently-used first
+# once the stored tensors exceed the memory cap. Key/values differ between
+# LoRA adapters, so every adapter gets its own tree (namespace).
+
+
+def kv_nbytes(kv):
+    return sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in kv)
+
+
+def slice_kv(kv, start, end=None):
+    # Copies so a cached segment never pins the larger tensor it came from
+    return [[key[:, :, start:end].clone(), value[:, :, start:end].clone()] for key, value in kv]
+
+
+class RadixNode:
+    def __init__(self, tokens=(), kv=None, parent=None):
+        self.tokens = tuple(tokens)
+        self.kv = kv
+        self.parent = parent
+        self.children = {}
+        self.last_access = time.monotonic()
+        self.nbytes = kv_nbytes(kv) if kv is not None else 0
+
+
+class PrefixCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.roots = {}
+        self.nbytes = 0
+        self.nodes = 0
+
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_tokens = 0
+        self.hit_tokens = 0
+        self.inserted_tokens = 0
+        self.evictions = 0
+
+    def root(self, namespace):
+        if namespace not in self.roots:
+            self.roots[namespace] = RadixNode()
+        return self.roots[namespace]
+
+    def match(self, token_ids, namespace=None):
+        # Longest cached prefix of token_ids -> (length, per-layer [key, value])
+        self.lookups += 1
+        self.lookup_tokens += len(token_ids)
+
+        node, matched, path = self.root(namespace), 0, []
+        now = time.monotonic()
+        while matched < len(token_ids):
+            child = node.children.get(token_ids[matched])
+            if child is None:
+                break
+
+            common = 0
+            limit = min(len(child.tokens), len(token_ids) - matched)
+            while common < limit and child.tokens[common] == token_ids[matched + common]:
+                common += 1
+
+            child.last_access = now
+            path.append((child, common))
+            matched += common
+            if common < len(child.tokens):
+                break
+            node = child
+
+        if not matched:
+            return 0, None
+
+        self.hits += 1
+        self.hit_tokens += matched
+        layers = len(path[0][0].kv)
+        kv = [
+            [
+                torch.cat([n.kv[layer][0][:, :, :used] for n, used in path], dim=2),
+                torch.cat([n.kv[layer][1][:, :, :used] for n, used in path], dim=2),
+            ]
+            for layer in range(layers)
+        ]
+        return matched, kv
+
+    def split(self, node, at):
+        # Turn node into its first `at` tokens with a child holding the rest
+        tail = RadixNode(node.tokens[at:], slice_kv(node.kv, at), parent=node)
+        tail.children = node.children
+        tail.last_access = node.last_access
+        for child in tail.children.values():
+            child.parent = tail
+
+        head_kv = slice_kv(node.kv, 0, at)
+        self.nbytes += tail.nbytes + kv_nbytes(head_kv) - node.nbytes
+        node.tokens = node.tokens[:at]
+        node.kv = head_kv
+        node.nbytes = kv_nbytes(head_kv)
+        node.children = {tail.tokens[0]: tail}
+        self.nodes += 1
+
+    def insert(self, token_ids, kv, namespace=None):
+        # kv holds [1, heads, len(token_ids), head_dim] tensors for every layer
+        if self.max_bytes <= 0 or not token_ids:
+            return
+
+        node, offset = self.root(namespace), 0
+        now = time.monotonic()
+        while offset < len(token_ids):
+            child = node.children.get(token_ids[offset])
+            if child is None:
+                leaf = RadixNode(token_ids[offset:], slice_kv(kv, offset), parent=node)
+                node.children[leaf.tokens[0]] = leaf
+                self.nbytes += leaf.nbytes
+                self.nodes += 1
+                self.inserted_tokens += len(leaf.tokens)
+                break
+
+            common = 0
+            limit = min(len(child.tokens), len(token_ids) - offset)
+            while common < limit and child.tokens[common] == token_ids[offset + common]:
+                common += 1
+
+            if common < len(child.tokens):
+                self.split(child, common)
+            child.last_access = now
+            node = child
+            offset += common
+
+        self.evict()
+
+    def evict(self):
+        while self.nbytes > self.max_bytes:
+            leaves = []
+            stack = [child for root in self.roots.values() for child in root.children.values()]
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                else:
+                    leaves.append(node)
+            if not leaves:
+                return
+
+            victim = min(leaves, key=lambda node: node.last_access)
+            del victim.parent.children[victim.tokens[0]]
+            self.nbytes -= victim.nbytes
+            self.nodes -= 1
+            self.evictions += 1
+
+    def clear(self):
+        self.roots = {}
+        self.nbytes = 0
+        self.nodes = 0
+
+    def stats(self):
+        return {
+            "nodes": self.nodes,
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "token_hit_rate": round(self.hit_tokens / self.lookup_tokens, 4) if self.lookup_tokens else 0.0,
+            "hit_tokens": self.hit_tokens,
+            "inserted_tokens": self.inserted_tokens,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,135 @@
+import gc
+import os
+import json
+import time
+import torch
+
+#### MICRO-BATCH PROBING
+#
+# Before training, find the largest micro-batch of `seq_len`-token sequences
+# the model can run forward and backward on without running out of device
+# memory: double the batch until it fails, then binary search between the
+# last size that fit and the first that did not. The answer only depends on
+# the model, the GPU and the sequence length, so it is cached in a JSON file
+# keyed on those and later runs skip straight to training. A safety margin
+# is taken off the result for optimizer state and allocator fragmentation.
+
+SAFETY_MARGIN = 0.85
+# The key assumes the whole GPU is ours. If other processes (say a warm
+# inference daemon) hold more than this much of it, including our own CUDA
+# context, the result is still used but not cached
+MAX_FOREIGN_MEMORY_GB = 2.0
+
+
+def probe_key(model_name, seq_len, settings=""):
+    gpu = torch.cuda.get_device_name(0)
+    memory_gb = round(torch.cuda.get_device_properties(0).total_memory / 2**30)
+    return f"{model_name}|{gpu}|{memory_gb}GB|{seq_len}|{settings}"
+
+
+def read_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache(path, cache):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp, path)
+
+
+def foreign_memory_gb():
+    # Device memory in use that this process did not allocate
+    free, total = torch.cuda.mem_get_info(0)
+    return (total - free - torch.cuda.memory_reserved(0)) / 2**30
+
+
+def is_oom(error):
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error).lower()
+
+
+def fits(model, batch_size, seq_len):
+    device = model.get_input_embeddings().weight.device
+    vocab_size = model.get_input_embeddings().weight.shape[0]
+    ok = True
+    try:
+        input_ids = torch.randint(0, vocab_size, (batch_size, seq_len), device=device)
+        with torch.autocast("cuda", dtype=torch.float16):
+            loss = model(input_ids=input_ids, labels=input_ids).loss
+        loss.backward()
+        torch.cuda.synchronize()
+    except RuntimeError as e:
+        if not is_oom(e):
+            raise
+        ok = False
+    # The traceback of an OOM holds on to activations until it is dropped
+    input_ids = loss = None
+    model.zero_grad(set_to_none=True)
+    gc.collect()
+    torch.cuda.empty_cache()
+    return ok
+
+
+def largest_batch(model, seq_len, max_batch, log=print):
+    if not fits(model, 1, seq_len):
+        raise RuntimeError(f"A single {seq_len}-token sequence does not fit in device memory")
+
+    good, bad = 1, None
+    while good < max_batch:
+        size = min(good * 2, max_batch)
+        if fits(model, size, seq_len):
+            log(f"Probe: batch {size} x {seq_len} fits")
+            good = size
+        else:
+            log(f"Probe: batch {size} x {seq_len} is out of memory")
+            bad = size
+            break
+
+    while bad is not None and bad - good > 1:
+        size = (good + bad) // 2
+        if fits(model, size, seq_len):
+            good = size
+        else:
+            bad = size
+    return good
+
+
+def probe_micro_batch(model, model_name, seq_len, cache_path, max_batch=64, settings="", log=print):
+    if not torch.cuda.is_available():
+        return None
+
+    key = probe_key(model_name, seq_len, settings)
+    cache = read_cache(cache_path)
+    if key in cache:
+        log(f"Probe cached: micro-batch {cache[key]['micro_batch']} for {key}")
+        return cache[key]["micro_batch"]
+
+    started = time.time()
+    foreign_gb = foreign_memory_gb()
+    was_training = model.training
+    model.train()
+    largest = largest_batch(model, seq_len, max_batch, log=log)
+    model.train(was_training)
+
+    micro_batch = max(1, int(largest * SAFETY_MARGIN))
+    peak_memory_gb = round(torch.cuda.max_memory_allocated() / 2**30, 2)
+    torch.cuda.reset_peak_memory_stats()
+    if foreign_gb > MAX_FOREIGN_MEMORY_GB:
+        log(f"Probe: largest batch {largest} x {seq_len}, using {micro_batch}; not cached, "
+            f"other processes held {foreign_gb:.1f} GB of device memory")
+        return micro_batch
+
+    cache[key] = {
+        "micro_batch": micro_batch,
+        "largest": largest,
+        "seq_len": seq_len,
+        "peak_memory_gb": peak_memory_gb,
+        "probe_seconds": round(time.time() - started, 1),
+    }
+    write_cache(cache_path, cache)
+    log(f"Probe: largest batch {largest} x {seq_len}, using {micro_batch} ({time.time() - started:.1f}s)")
+    return micro_batch
@@ -0,0 +1,147 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+
+#### RESUMABLE AND INCREMENTAL TRAINING
+#
+# runway_lora/run_manifest.json describes the run that owns the directory:
+# the dataset it trained on (sha256 and byte length of dataset.jsonl, and the
+# first row it used), the training settings, and whether it completed. A new
+# run with exactly the same plan picks up from the newest checkpoint that was
+# fully written, restoring optimizer, scheduler and RNG state through the
+# Trainer. In incremental mode, once a run has completed and rows have since
+# been appended to dataset.jsonl (the old file is a byte prefix of the new
+# one), the next run continues the finished adapter on the new rows only.
+
+MANIFEST = "run_manifest.json"
+CHECKPOINT = re.compile(r"^checkpoint-(\d+)$")
+CHECKPOINT_FILES = ["trainer_state.json", "optimizer.pt", "scheduler.pt"]
+ADAPTER_FILES = ["adapter_model.safetensors", "adapter_model.bin"]
+
+
+def dataset_digest(path, length=None):
+    digest, remaining = hashlib.sha256(), length
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(output_dir, manifest):
+    os.makedirs(output_dir, exist_ok=True)
+    tmp = os.path.join(output_dir, MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(output_dir, MANIFEST))
+
+
+def has_adapter(path):
+    return any(os.path.exists(os.path.join(path, name)) for name in ADAPTER_FILES)
+
+
+def checkpoints(output_dir):
+    found = []
+    if os.path.isdir(output_dir):
+        for name in os.listdir(output_dir):
+            match = CHECKPOINT.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(output_dir, name)))
+    return [path for _, path in sorted(found, reverse=True)]
+
+
+def is_valid_checkpoint(path):
+    if not has_adapter(path):
+        return False
+    if not all(os.path.exists(os.path.join(path, name)) for name in CHECKPOINT_FILES):
+        return False
+    try:
+        with open(os.path.join(path, "trainer_state.json")) as f:
+            json.load(f)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def latest_checkpoint(output_dir):
+    # A session dropped mid-save leaves the newest checkpoint incomplete;
+    # save_total_limit=2 keeps the one before it around
+    for path in checkpoints(output_dir):
+        if is_valid_checkpoint(path):
+            return path
+    return None
+
+
+def clear_checkpoints(output_dir):
+    for path in checkpoints(output_dir):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# Decides how this run trains:
+#   start_row     - first dataset row to train on
+#   init_adapter  - continue from the adapter saved in output_dir
+#   resume_from   - checkpoint to resume, or None
+#   nothing_to_do - incremental run with no new rows
+def plan_run(output_dir, dataset_path, settings, incremental=False, log=print):
+    dataset_bytes = os.path.getsize(dataset_path)
+    plan = {
+        "dataset_sha256": dataset_digest(dataset_path),
+        "dataset_bytes": dataset_bytes,
+        "start_row": 0,
+        "init_adapter": False,
+        "settings": settings,
+    }
+    previous = read_manifest(output_dir)
+
+    if previous and previous.get("status") == "running":
+        # Same plan as the interrupted run apart from where it started
+        candidate = {**plan, "start_row": previous["plan"]["start_row"], "init_adapter": previous["plan"]["init_adapter"]}
+        if candidate == previous["plan"]:
+            checkpoint = latest_checkpoint(output_dir)
+            log(f"Resuming interrupted run from {checkpoint}" if checkpoint else "Restarting interrupted run, no complete checkpoint")
+            return {**candidate, "resume_from": checkpoint, "nothing_to_do": False}
+
+    if incremental and previous and previous.get("status") == "completed" and previous["plan"]["settings"] == settings:
+        old = previous["plan"]
+        appended = (
+            dataset_bytes >= old["dataset_bytes"]
+            and dataset_digest(dataset_path, old["dataset_bytes"]) == old["dataset_sha256"]
+            and has_adapter(output_dir)
+        )
+        if appended and dataset_bytes == old["dataset_bytes"]:
+            log("Dataset unchanged since the last completed run, nothing new to train on")
+            return {**plan, "resume_from": None, "nothing_to_do": True}
+        if appended:
+            start_row = previous["rows"]
+            log(f"Incremental run: continuing the adapter on rows {start_row} onwards")
+            clear_checkpoints(output_dir)
+            return {**plan, "start_row": start_row, "init_adapter": True, "resume_from": None, "nothing_to_do": False}
+        log("Dataset changed other than by appending rows, training from scratch")
+
+    clear_checkpoints(output_dir)
+    return {**plan, "resume_from": None, "nothing_to_do": False}
+
+
+def start_run(output_dir, plan, rows):
+    keys = ["dataset_sha256", "dataset_bytes", "start_row", "init_adapter", "settings"]
+    write_manifest(output_dir, {"status": "running", "rows": rows, "plan": {key: plan[key] for key in keys}})
+
+
+def finish_run(output_dir):
+    manifest = read_manifest(output_dir)
+    manifest["status"] = "completed"
+    write_manifest(output_dir, manifest)
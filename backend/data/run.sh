@@ -1,7 +1,10 @@
 #!/bin/bash
+# A failed training run has to fail this script, or the API materializes
+# and reports a model that was never trained
+set -eo pipefail
 
 source .venv/bin/activate
 
 echo "Train script starting..."
 python train_script.py
-echo "Train script finished!"
\ No newline at end of file
+echo "Train script finished!"
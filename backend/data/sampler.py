@@ -0,0 +1,105 @@
+import random
+import datasets
+from torch.utils.data import DataLoader
+from transformers import Trainer
+from transformers.trainer_utils import seed_worker
+
+#### TOKEN-BUDGET BATCHING
+#
+# Instead of a fixed number of examples per batch, examples are sorted by
+# length and cut into batches whose padded size (examples x longest example)
+# stays under `max_tokens`, so a batch of short examples holds many of them
+# and a long example may get a batch to itself. Batches are built once, so
+# the number of steps per epoch is fixed, and only their order is shuffled
+# every epoch.
+
+
+class TokenBudgetBatchSampler:
+    def __init__(self, lengths, max_tokens, shuffle=True, seed=0):
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        # Ties are broken randomly so equal-length examples do not always
+        # share a batch in dataset order
+        rng = random.Random(seed)
+        order = sorted(range(len(lengths)), key=lambda i: (lengths[i], rng.random()))
+
+        self.batches, batch, longest = [], [], 0
+        for i in order:
+            if batch and max(longest, lengths[i]) * (len(batch) + 1) > max_tokens:
+                self.batches.append(batch)
+                batch, longest = [], 0
+            batch.append(i)
+            longest = max(longest, lengths[i])
+        if batch:
+            self.batches.append(batch)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def examples_per_batch(self):
+        return sum(len(batch) for batch in self.batches) / max(1, len(self.batches))
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        batches = list(self.batches)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(batches)
+        return iter(batches)
+
+
+def real_tokens(inputs):
+    # Tokens in a collated batch without the padding, which the Trainer's
+    # num_input_tokens_seen counts (it is input_ids.numel())
+    mask = inputs.get("attention_mask")
+    if mask is not None and mask.dim() == 2:
+        return int(mask.sum())
+    position_ids = inputs.get("position_ids")
+    if position_ids is not None:
+        # Packed rows (4D mask) are padded at the end with position 0, and
+        # every packed example is longer than one token, so a row's real
+        # length runs up to its last non-zero position
+        width = position_ids.shape[1]
+        nonzero = position_ids != 0
+        last = width - 1 - nonzero.flip(1).int().argmax(1)
+        return int(((last + 1) * nonzero.any(1)).sum())
+    return inputs["input_ids"].numel()
+
+
+class TokenBudgetTrainer(Trainer):
+    def __init__(self, *args, batch_sampler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sampler = batch_sampler
+        # Real (unpadded) training tokens seen by this process, for throughput
+        self.real_tokens_seen = 0
+
+    def get_batch_samples(self, epoch_iterator, num_batches):
+        batch_samples, num_items_in_batch = super().get_batch_samples(epoch_iterator, num_batches)
+        self.real_tokens_seen += sum(real_tokens(inputs) for inputs in batch_samples)
+        return batch_samples, num_items_in_batch
+
+    def get_train_dataloader(self):
+        if self.batch_sampler is None:
+            return super().get_train_dataloader()
+
+        train_dataset = self.train_dataset
+        data_collator = self.data_collator
+        if isinstance(train_dataset, datasets.Dataset):
+            train_dataset = self._remove_unused_columns(train_dataset, description="training")
+        else:
+            data_collator = self._get_collator_with_removed_columns(data_collator, description="training")
+
+        dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=self.batch_sampler,
+            collate_fn=data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers,
+            worker_init_fn=seed_worker,
+        )
+        return self.accelerator.prepare(dataloader)
@@ -0,0 +1,444 @@
+import time
+import queue
+import threading
+import torch
+import torch.nn.functional as F
+from collections import deque
+from transformers import DynamicCache
+
+#### CONTINUOUS BATCHING
+#
+# Every running sequence shares one left-padded key/value cache. Each step
+# admits waiting requests (prefilled on their own, then padded into the
+# batch), decodes one token for every active sequence in a single forward
+# pass, and retires whatever finished so its slot is free on the next step.
+# With a PrefixCache attached, prefill only runs the part of a prompt that
+# is not already cached, and finished sequences are written back so the
+# next turn of the same conversation can reuse them. With an
+# AdapterRegistry attached, each row runs through its own LoRA adapter. With
+# a SpeculativeDecoder attached, a lone greedy request with nothing queued
+# behind it is decoded speculatively, several tokens per forward pass.
+
+
+class GenerationRequest:
+    def __init__(self, prompt_ids, max_tokens=1000, temperature=0.7, top_p=0.9, adapter=None, stopping=None):
+        self.prompt_ids = list(prompt_ids)
+        self.adapter = adapter
+        # Optional callable run on every sampled token id, True ends the
+        # sequence right there (stop strings are matched on decoded text)
+        self.stopping = stopping
+        self.adapter_name = None
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.generated = []
+        self.finish_reason = None
+        self.error = None
+        # Set from the connection thread when the client has gone away; the
+        # scheduler retires the request before its next step
+        self.cancelled = False
+        self.submitted_at = time.monotonic()
+        self.first_token_at = None
+        self.finished_at = None
+        # Tokens are handed to the caller through a queue so a slow reader
+        # never holds up the decode loop; None marks the end of the stream
+        self.tokens = queue.Queue()
+        self.next_token = None
+        self.cache_length = 0
+        self.cached_tokens = 0
+
+    @property
+    def reserved_tokens(self):
+        return len(self.prompt_ids) + self.max_tokens
+
+    def emit(self, token_id):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self.generated.append(token_id)
+        self.next_token = token_id
+        self.tokens.put(token_id)
+
+    def finish(self, reason, error=None):
+        self.finish_reason = reason
+        self.error = error
+        self.finished_at = time.monotonic()
+        self.tokens.put(None)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def stream(self):
+        while True:
+            token_id = self.tokens.get()
+            if token_id is None:
+                return
+            yield token_id
+
+    def result(self):
+        for _ in self.stream():
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.generated
+
+
+def sample_tokens(logits, temperatures, top_ps):
+    # Per-row temperature / nucleus sampling; a temperature of 0 means greedy
+    logits = logits.float()
+    greedy = logits.argmax(dim=-1)
+
+    probs = torch.softmax(logits / temperatures.clamp(min=1e-5).unsqueeze(1), dim=-1)
+    sorted_probs, sorted_ids = probs.sort(dim=-1, descending=True)
+    cumulative = sorted_probs.cumsum(dim=-1)
+    sorted_probs = sorted_probs.masked_fill(cumulative - sorted_probs > top_ps.unsqueeze(1), 0.0)
+    sampled = sorted_ids.gather(1, torch.multinomial(sorted_probs, 1)).squeeze(1)
+
+    return torch.where(temperatures <= 0, greedy, sampled)
+
+
+def to_legacy(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def pad_cache_left(cache, pad):
+    # [batch, heads, seq, head_dim] -> pad the seq dimension on the left
+    return [[F.pad(key, (0, 0, pad, 0)), F.pad(value, (0, 0, pad, 0))] for key, value in cache]
+
+
+class BatchScheduler:
+    def __init__(self, model, eos_token_id=None, max_batch_size=8, max_batch_tokens=16384, prefix_cache=None, adapters=None, speculative=None):
+        self.model = model
+        self.device = model.device
+        self.eos_token_id = eos_token_id
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.prefix_cache = prefix_cache
+        self.adapters = adapters
+        self.speculative = speculative
+
+        self.waiting = deque()
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+        self.steps = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.generated_tokens = 0
+        self.prefill_tokens = 0
+        self.busy_seconds = 0.0
+
+    #### LIFECYCLE
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="batch-scheduler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, request):
+        if request.max_tokens <= 0:
+            request.finish("length")
+            return request
+
+        with self.condition:
+            self.waiting.append(request)
+            self.condition.notify()
+        return request
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.waiting and not self.active and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    break
+
+            started = time.monotonic()
+            try:
+                self.step()
+            except Exception as e:
+                self.fail_active(e)
+            self.busy_seconds += time.monotonic() - started
+
+        self.fail_active(RuntimeError("Scheduler stopped"))
+        with self.condition:
+            while self.waiting:
+                self.waiting.popleft().finish("error", RuntimeError("Scheduler stopped"))
+
+    def fail_active(self, error):
+        for request in self.active:
+            self.release(request)
+            request.finish("error", error)
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+
+    #### SCHEDULING
+
+    def step(self):
+        self.drop_cancelled()
+        self.admit()
+        if self.can_speculate():
+            self.speculate()
+        elif self.active:
+            self.decode()
+
+    def drop_cancelled(self):
+        with self.condition:
+            cancelled = [request for request in self.waiting if request.cancelled]
+            for request in cancelled:
+                self.waiting.remove(request)
+        for request in cancelled:
+            request.finish("cancelled")
+            self.cancelled += 1
+
+        for request in self.active:
+            if request.cancelled and request.finish_reason is None:
+                request.finish("cancelled")
+                self.cancelled += 1
+        if self.active:
+            self.retire()
+
+    def can_speculate(self):
+        # Batching already keeps the GPU busy once there is more than one
+        # sequence, and a sampled request cannot be verified token for token
+        if self.speculative is None or len(self.active) != 1:
+            return False
+        with self.condition:
+            if self.waiting:
+                return False
+        return self.speculative.eligible(self.active[0])
+
+    def next_admission(self):
+        with self.condition:
+            if not self.waiting or len(self.active) >= self.max_batch_size:
+                return None
+
+            # An empty batch always takes the next request so oversized
+            # prompts cannot starve, otherwise the token budget applies
+            reserved = sum(request.reserved_tokens for request in self.active)
+            if self.active and reserved + self.waiting[0].reserved_tokens > self.max_batch_tokens:
+                return None
+            return self.waiting.popleft()
+
+    def admit(self):
+        while True:
+            request = self.next_admission()
+            if request is None:
+                return
+            try:
+                self.prefill(request)
+            except Exception as e:
+                self.release(request)
+                request.finish("error", e)
+
+    def release(self, request):
+        if self.adapters is not None and request.adapter_name is not None:
+            self.adapters.release(request.adapter_name)
+            request.adapter_name = None
+
+    def forward_kwargs(self, requests):
+        if self.adapters is None:
+            return {}
+        return {"adapter_names": [request.adapter_name for request in requests]}
+
+    def accept(self, request, token_id):
+        request.emit(token_id)
+        self.generated_tokens += 1
+
+        if self.eos_token_id is not None and token_id == self.eos_token_id:
+            request.finish("stop")
+        elif request.stopping is not None and request.stopping(token_id):
+            request.finish("stop")
+        elif len(request.generated) >= request.max_tokens:
+            request.finish("length")
+
+        if request.finish_reason is not None:
+            self.completed += 1
+
+    def sample(self, logits, requests):
+        temperatures = torch.tensor([float(r.temperature or 0.0) for r in requests], device=logits.device)
+        top_ps = torch.tensor([float(1.0 if r.top_p is None else r.top_p) for r in requests], device=logits.device)
+        return sample_tokens(logits, temperatures, top_ps).tolist()
+
+    #### MODEL PASSES
+
+    @torch.inference_mode()
+    def prefill(self, request):
+        prompt_ids = request.prompt_ids
+        if self.adapters is not None:
+            request.adapter_name = self.adapters.acquire(request.adapter)
+
+        cached, past = 0, None
+        if self.prefix_cache is not None:
+            # The last prompt token always goes through the model for logits
+            cached, past = self.prefix_cache.match(prompt_ids[:-1], request.adapter_name)
+
+        input_ids = torch.tensor([prompt_ids[cached:]], device=self.device)
+        if cached:
+            output = self.model(
+                input_ids=input_ids,
+                position_ids=torch.arange(cached, len(prompt_ids), device=self.device).unsqueeze(0),
+                past_key_values=DynamicCache.from_legacy_cache(tuple(tuple(kv) for kv in past)),
+                use_cache=True,
+                **self.forward_kwargs([request])
+            )
+        else:
+            output = self.model(input_ids=input_ids, use_cache=True, **self.forward_kwargs([request]))
+
+        cache = to_legacy(output.past_key_values)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(prompt_ids, cache, request.adapter_name)
+
+        request.cached_tokens = cached
+        request.cache_length = len(prompt_ids)
+        self.prefill_tokens += len(prompt_ids) - cached
+        self.accept(request, self.sample(output.logits[:, -1, :], [request])[0])
+        if request.finish_reason is None:
+            self.join(request, cache)
+        else:
+            self.release(request)
+
+    def join(self, request, cache):
+        cache = [[key, value] for key, value in cache]
+        length = cache[0][0].shape[2]
+        mask = torch.ones((1, length), dtype=torch.long, device=self.device)
+
+        if self.cache is None:
+            self.cache, self.attention_mask = cache, mask
+        else:
+            batch_length = self.attention_mask.shape[1]
+            if length < batch_length:
+                cache = pad_cache_left(cache, batch_length - length)
+                mask = F.pad(mask, (batch_length - length, 0))
+            elif length > batch_length:
+                self.cache = pad_cache_left(self.cache, length - batch_length)
+                self.attention_mask = F.pad(self.attention_mask, (length - batch_length, 0))
+
+            self.cache = [
+                [torch.cat([key, new_key]), torch.cat([value, new_value])]
+                for (key, value), (new_key, new_value) in zip(self.cache, cache)
+            ]
+            self.attention_mask = torch.cat([self.attention_mask, mask])
+
+        self.active.append(request)
+
+    @torch.inference_mode()
+    def decode(self):
+        batch = len(self.active)
+        input_ids = torch.tensor([[r.next_token] for r in self.active], device=self.device)
+        position_ids = torch.tensor([[r.cache_length] for r in self.active], device=self.device)
+        attention_mask = torch.cat([
+            self.attention_mask,
+            torch.ones((batch, 1), dtype=self.attention_mask.dtype, device=self.device)
+        ], dim=1)
+
+        output = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=DynamicCache.from_legacy_cache(tuple(tuple(kv) for kv in self.cache)),
+            use_cache=True,
+            **self.forward_kwargs(self.active)
+        )
+        self.cache = [[key, value] for key, value in to_legacy(output.past_key_values)]
+        self.attention_mask = attention_mask
+        self.steps += 1
+
+        for request in self.active:
+            request.cache_length += 1
+        for request, token_id in zip(self.active, self.sample(output.logits[:, -1, :], self.active)):
+            self.accept(request, token_id)
+
+        self.retire()
+
+    @torch.inference_mode()
+    def speculate(self):
+        # A single row never carries left padding (retire drops columns that
+        # are padding for every row), so its cache is exactly cache_length long
+        request = self.active[0]
+        token_ids, past = self.speculative.step(self.model, request, self.cache, self.forward_kwargs([request]))
+        self.steps += 1
+
+        emitted = 0
+        for token_id in token_ids:
+            self.accept(request, token_id)
+            emitted += 1
+            if request.finish_reason is not None:
+                break
+
+        # Keep next_token plus the emitted drafts, all but the newest token
+        request.cache_length += emitted
+        past.crop(request.cache_length)
+        self.cache = [[key, value] for key, value in to_legacy(past)]
+        self.attention_mask = torch.ones((1, request.cache_length), dtype=torch.long, device=self.device)
+        self.retire()
+
+    def remember(self, row, request):
+        # Everything fed through the model so far: the prompt plus all but
+        # the last sampled token, right-aligned in this row of the cache
+        length = request.cache_length
+        token_ids = (request.prompt_ids + request.generated)[:length]
+        kv = [[key[row:row + 1, :, -length:], value[row:row + 1, :, -length:]] for key, value in self.cache]
+        self.prefix_cache.insert(token_ids, kv, request.adapter_name)
+
+    def retire(self):
+        keep = [i for i, request in enumerate(self.active) if request.finish_reason is None]
+        if len(keep) == len(self.active):
+            return
+
+        for row, request in enumerate(self.active):
+            if request.finish_reason is None:
+                continue
+            if self.prefix_cache is not None and request.finish_reason in ("stop", "length"):
+                self.remember(row, request)
+            self.release(request)
+
+        if not keep:
+            self.active, self.cache, self.attention_mask = [], None, None
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        self.cache = [[key.index_select(0, index), value.index_select(0, index)] for key, value in self.cache]
+        self.attention_mask = self.attention_mask.index_select(0, index)
+        self.active = [self.active[i] for i in keep]
+
+        # Columns that are padding for every remaining row are dead weight
+        first = int(self.attention_mask.any(dim=0).int().argmax())
+        if first > 0:
+            self.cache = [[key[:, :, first:], value[:, :, first:]] for key, value in self.cache]
+            self.attention_mask = self.attention_mask[:, first:]
+
+    #### METRICS
+
+    def stats(self):
+        with self.condition:
+            waiting = len(self.waiting)
+        return {
+            "active": len(self.active),
+            "waiting": waiting,
+            "max_batch_size": self.max_batch_size,
+            "max_batch_tokens": self.max_batch_tokens,
+            "steps": self.steps,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "generated_tokens": self.generated_tokens,
+            "prefill_tokens": self.prefill_tokens,
+            "tokens_per_second": round(self.generated_tokens / self.busy_seconds, 2) if self.busy_seconds else 0.0,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache is not None else None,
+            "adapters": self.adapters.stats() if self.adapters is not None else None,
+            "speculative": self.speculative.stats() if self.speculative is not None else None,
+        }
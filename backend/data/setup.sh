@@ -1,13 +1,36 @@
 #!/bin/bash
+# Provisions ~/runway/.venv. core/trainer.py skips this script entirely when
+# .venv/.tuna_env already holds the fingerprint it passes in; otherwise the
+# existing venv and the wheelhouse are reused so only what changed is
+# downloaded and installed.
+set -e
+
+WHEELHOUSE="$HOME/.cache/tuna/wheelhouse"
+MARKER=".venv/.tuna_env"
 
 echo "Checking dependencies..."
 
-sudo apt-get update
-sudo apt-get install -y python3-pip python3-dev python3-venv
+if ! dpkg -s python3-pip python3-dev python3-venv > /dev/null 2>&1; then
+    sudo apt-get update
+    sudo apt-get install -y python3-pip python3-dev python3-venv
+fi
 
-python3 -m venv .venv
+# A venv built by a different interpreter is useless, anything else is kept
+if [ ! -x .venv/bin/python ] || [ "$(.venv/bin/python -V 2>&1)" != "$(python3 -V 2>&1)" ]; then
+    rm -rf .venv
+    python3 -m venv .venv
+fi
 source .venv/bin/activate
+rm -f "$MARKER"
+
+# Wheels already in the wheelhouse are not downloaded again, and a rebuilt
+# venv installs from it without touching the network
+mkdir -p "$WHEELHOUSE"
+pip wheel -q -r requirements.txt -w "$WHEELHOUSE" --find-links "$WHEELHOUSE"
+pip install -q --no-index --find-links "$WHEELHOUSE" -r requirements.txt
 
-pip install torch datasets transformers peft bitsandbytes accelerate huggingface-hub
+if [ -n "$TUNA_ENV_FINGERPRINT" ]; then
+    echo "$TUNA_ENV_FINGERPRINT" > "$MARKER"
+fi
 
-echo "Done installing dependencies!"
\ No newline at end of file
+echo "Done installing dependencies!"
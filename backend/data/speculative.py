@@ -0,0 +1,128 @@
+import torch
+from transformers import DynamicCache
+
+#### SPECULATIVE DECODING
+#
+# At batch size 1 a decode step is bound by reading the weights, not by
+# compute, so checking several tokens costs about the same as producing one.
+# A proposer guesses the next few tokens cheaply, the target model scores
+# them all in one forward pass, and the longest prefix matching the target's
+# own greedy choice is kept plus the target's next token. Output is
+# identical to plain greedy decoding; only the number of target passes
+# changes. Two proposers:
+#   - PromptLookupProposer: copies what followed the latest earlier
+#     occurrence of the current n-gram (no extra model, good for replies
+#     that quote the prompt or repeat themselves)
+#   - DraftModelProposer: greedy decoding with a small model that shares
+#     the target's tokenizer (e.g. Llama-3.2-1B for Llama-3.2-3B)
+
+
+class PromptLookupProposer:
+    def __init__(self, max_ngram=3, min_ngram=1):
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def propose(self, request, token_ids, count):
+        for size in range(self.max_ngram, self.min_ngram - 1, -1):
+            if len(token_ids) <= size:
+                continue
+            tail = token_ids[-size:]
+            for start in range(len(token_ids) - size - 1, -1, -1):
+                if token_ids[start:start + size] == tail:
+                    continuation = token_ids[start + size:start + size + count]
+                    if continuation:
+                        return continuation
+        return []
+
+
+class DraftModelProposer:
+    def __init__(self, model):
+        self.model = model
+        self.device = model.device
+        # The draft keeps its own cache for the sequence being sped up and
+        # rolls it back to whatever part of its guess the target accepted
+        self.request = None
+        self.cache = None
+        self.cached_ids = []
+
+    @torch.inference_mode()
+    def propose(self, request, token_ids, count):
+        if request is not self.request:
+            self.request, self.cache, self.cached_ids = request, DynamicCache(), []
+
+        common = 0
+        limit = min(len(self.cached_ids), len(token_ids) - 1)
+        while common < limit and self.cached_ids[common] == token_ids[common]:
+            common += 1
+        self.cache.crop(common)
+        self.cached_ids = token_ids[:common]
+
+        drafts, feed = [], token_ids[common:]
+        for _ in range(count):
+            output = self.model(
+                input_ids=torch.tensor([feed], device=self.device),
+                past_key_values=self.cache,
+                use_cache=True
+            )
+            self.cache = output.past_key_values
+            self.cached_ids = self.cached_ids + feed
+            feed = [int(output.logits[0, -1].argmax())]
+            drafts.append(feed[0])
+        return drafts
+
+
+class SpeculativeDecoder:
+    def __init__(self, proposer, num_draft=4):
+        self.proposer = proposer
+        self.num_draft = num_draft
+
+        self.steps = 0
+        self.drafted = 0
+        self.accepted = 0
+        self.emitted = 0
+
+    @staticmethod
+    def eligible(request):
+        return not request.temperature
+
+    @torch.inference_mode()
+    def step(self, model, request, cache, forward_kwargs):
+        # cache: legacy per-layer [key, value] for the request's first
+        # cache_length tokens, i.e. everything but next_token. Returns the
+        # tokens to emit and the target cache, which also covers next_token
+        # and every draft, so the caller crops it to what it emitted.
+        token_ids = request.prompt_ids + request.generated
+        remaining = request.max_tokens - len(request.generated)
+        drafts = self.proposer.propose(request, token_ids, min(self.num_draft, remaining - 1)) if remaining > 1 else []
+
+        start = request.cache_length
+        input_ids = [request.next_token] + drafts
+        output = model(
+            input_ids=torch.tensor([input_ids], device=model.device),
+            position_ids=torch.arange(start, start + len(input_ids), device=model.device).unsqueeze(0),
+            past_key_values=DynamicCache.from_legacy_cache(tuple(tuple(kv) for kv in cache)),
+            use_cache=True,
+            **forward_kwargs
+        )
+        targets = output.logits[0].argmax(dim=-1).tolist()
+
+        accepted = 0
+        while accepted < len(drafts) and drafts[accepted] == targets[accepted]:
+            accepted += 1
+
+        self.steps += 1
+        self.drafted += len(drafts)
+        self.accepted += accepted
+        self.emitted += accepted + 1
+        return drafts[:accepted] + [targets[accepted]], output.past_key_values
+
+    def stats(self):
+        return {
+            "proposer": type(self.proposer).__name__,
+            "num_draft": self.num_draft,
+            "steps": self.steps,
+            "drafted_tokens": self.drafted,
+            "accepted_tokens": self.accepted,
+            "acceptance_rate": round(self.accepted / self.drafted, 4) if self.drafted else 0.0,
+            "tokens_per_step": round(self.emitted / self.steps, 3) if self.steps else 0.0,
+        }
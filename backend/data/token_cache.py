@@ -0,0 +1,150 @@
+import os
+import copy
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+from datasets import load_dataset
+
+#### PRE-TOKENIZED DATASET CACHE
+#
+# Tokenized datasets are stored under a key hashed from the dataset file, the
+# tokenizer (its full serialized vocabulary and settings), the prompt template
+# and max_length, so a re-run or a hyperparameter retry on the same data skips
+# loading and tokenizing entirely. Each entry is two flat arrays:
+#   ids.npy     - every example's token ids back to back (uint32)
+#   offsets.npy - example i is ids[offsets[i]:offsets[i + 1]] (int64)
+# both opened memory-mapped, so loading is instant and pages come in as the
+# dataloader touches them. Entries are written to a temporary directory and
+# renamed into place, so a crashed build never leaves a half-written entry.
+
+CACHE_VERSION = 1
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tokenizer_digest(tokenizer):
+    digest = hashlib.sha256(type(tokenizer).__name__.encode())
+    if getattr(tokenizer, "is_fast", False):
+        # Truncation and padding are left on the backend by the last call,
+        # they are not part of what the tokenizer produces
+        state = json.loads(tokenizer.backend_tokenizer.to_str())
+        state.pop("truncation", None)
+        state.pop("padding", None)
+        digest.update(json.dumps(state, sort_keys=True).encode())
+    else:
+        digest.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode())
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def cache_key(dataset_path, tokenizer, template, max_length):
+    parts = [str(CACHE_VERSION), file_digest(dataset_path), tokenizer_digest(tokenizer), template, str(max_length)]
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()[:32]
+
+
+class TokenizedDataset(torch.utils.data.Dataset):
+    def __init__(self, path):
+        self.path = path
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.rows = np.arange(len(self.offsets) - 1)
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def tokens(self, i):
+        row = self.rows[i]
+        return self.ids[self.offsets[row]:self.offsets[row + 1]]
+
+    def select(self, indices):
+        # A subset of the examples, sharing the same memory-mapped ids
+        view = copy.copy(self)
+        view.rows = self.rows[indices]
+        view.lengths = self.lengths[indices]
+        return view
+
+    def tail(self, start):
+        return self.select(np.arange(start, len(self)))
+
+    def sequences(self):
+        for i in range(len(self)):
+            yield self.tokens(i).tolist()
+
+    def __getitem__(self, i):
+        input_ids = torch.from_numpy(self.tokens(i).astype(np.int64))
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+
+def build(dataset_path, tokenizer, template, max_length, path, num_proc=None):
+    dataset = load_dataset("json", data_files=dataset_path, split="train")
+
+    def tokenize(examples):
+        columns = list(examples.keys())
+        prompts = [template.format(**{c: examples[c][i] for c in columns}) for i in range(len(examples[columns[0]]))]
+        tokens = tokenizer(prompts, truncation=True, max_length=max_length, padding=False, return_attention_mask=False)
+        return {"input_ids": tokens["input_ids"], "length": [len(ids) for ids in tokens["input_ids"]]}
+
+    # Worker processes only pay off once there are enough rows to split
+    num_proc = num_proc or max(1, min(os.cpu_count() or 1, len(dataset) // 1000))
+    dataset = dataset.map(
+        tokenize,
+        batched=True,
+        batch_size=1000,
+        num_proc=num_proc if num_proc > 1 else None,
+        remove_columns=dataset.column_names,
+        desc="Tokenizing dataset",
+    )
+
+    offsets = np.zeros(len(dataset) + 1, dtype=np.int64)
+    np.cumsum(dataset["length"], out=offsets[1:])
+
+    tmp = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    ids = np.lib.format.open_memmap(os.path.join(tmp, "ids.npy"), mode="w+", dtype=np.uint32, shape=(int(offsets[-1]),))
+    start = 0
+    for batch in dataset.iter(batch_size=10000):
+        flat = np.fromiter((t for row in batch["input_ids"] for t in row), dtype=np.uint32)
+        ids[start:start + len(flat)] = flat
+        start += len(flat)
+    ids.flush()
+    del ids
+    np.save(os.path.join(tmp, "offsets.npy"), offsets)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"examples": len(dataset), "tokens": int(offsets[-1]), "max_length": max_length, "template": template}, f)
+
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Another run finished the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def prune(cache_dir, keep):
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if ".tmp-" not in name]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for path in entries[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def load_tokenized(dataset_path, tokenizer, template, max_length, cache_dir, keep=4, log=print):
+    key = cache_key(dataset_path, tokenizer, template, max_length)
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        log(f"Token cache hit ({key})")
+        os.utime(path)
+    else:
+        log(f"Token cache miss ({key}), tokenizing...")
+        os.makedirs(cache_dir, exist_ok=True)
+        build(dataset_path, tokenizer, template, max_length, path)
+        prune(cache_dir, keep)
+    return TokenizedDataset(path)
@@ -1,58 +1,176 @@
 import os
+import math
+import time
 import torch
-from datasets import load_dataset
+import numpy as np
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
     TrainingArguments,
-    Trainer,
     DataCollatorForLanguageModeling,
     TrainerCallback,
     TrainerState,
     TrainerControl,
+    EarlyStoppingCallback,
 )
-from peft import LoraConfig, get_peft_model
+from peft import LoraConfig, PeftModel, get_peft_model
 from pathlib import Path
 import json
 from typing import Dict
 from huggingface_hub import login
+from packing import pack_examples, PackedCollator
+from sampler import TokenBudgetBatchSampler, TokenBudgetTrainer
+from token_cache import load_tokenized
+from resume import plan_run, start_run, finish_run
+from probe import probe_micro_batch
 
-with open("/home/ubuntu/runway/secrets.txt", "r") as f:
+# Overridden when the API runs against a local stand-in for the GPU host
+RUNWAY_DIR = os.environ.get("RUNWAY_DIR", "/home/ubuntu/runway")
+
+with open(os.path.join(RUNWAY_DIR, "secrets.txt"), "r") as f:
     login(token=f.read().strip())
 
-with open("/home/ubuntu/runway/config.json", "r") as js:
+with open(os.path.join(RUNWAY_DIR, "config.json"), "r") as js:
     config = json.load(js)
     MODEL = config["model"]
+    PROMPT_TEMPLATE = "input: {input}\noutput: {output}"
+    # Per-example token limit, and optional packing of examples into
+    # `pack_length`-token blocks (see packing.py)
+    MAX_LENGTH = config.get("max_length", 128)
+    PACKING = config.get("packing", False)
+    PACK_LENGTH = config.get("pack_length", 2048)
+    # Optional token budget per batch (padded tokens) in place of one example
+    # per batch; gradient accumulation is then set so an optimizer step still
+    # sees about `examples_per_step` examples
+    MAX_BATCH_TOKENS = config.get("max_batch_tokens")
+    # Probe the largest micro-batch that fits before training (cached per
+    # model, GPU and sequence length). With max_batch_tokens "auto" the token
+    # budget is taken from the probe too
+    PROBE_BATCH_SIZE = config.get("probe_batch_size", True)
+    EXAMPLES_PER_STEP = config.get("examples_per_step", 4)
+    # Continue the last completed adapter on rows appended to dataset.jsonl
+    # since it was trained, instead of retraining on everything
+    INCREMENTAL = config.get("incremental", False)
+    # Hold out `eval_fraction` of the rows, evaluate every epoch and stop once
+    # eval loss has not improved by `early_stopping_threshold` for
+    # `early_stopping_patience` epochs, keeping the best adapter
+    EVAL_FRACTION = config.get("eval_fraction", 0.1)
+    EARLY_STOPPING_PATIENCE = config.get("early_stopping_patience", 3)
+    EARLY_STOPPING_THRESHOLD = config.get("early_stopping_threshold", 0.01)
+
+NUM_EPOCHS = 20
+LEARNING_RATE = 5e-5
+# Below this many rows there is too little data to hold any out
+MIN_EVAL_ROWS = 10
+OUTPUT_DIR = os.path.join(RUNWAY_DIR, "runway_lora")
+# A run only resumes or continues another one trained with the same settings
+TRAINING_SETTINGS = {
+    "model": MODEL,
+    "template": PROMPT_TEMPLATE,
+    "max_length": MAX_LENGTH,
+    "packing": PACKING,
+    "pack_length": PACK_LENGTH,
+    "max_batch_tokens": MAX_BATCH_TOKENS,
+    "examples_per_step": EXAMPLES_PER_STEP,
+    "epochs": NUM_EPOCHS,
+    "learning_rate": LEARNING_RATE,
+    "eval_fraction": EVAL_FRACTION,
+    "early_stopping_patience": EARLY_STOPPING_PATIENCE,
+    "early_stopping_threshold": EARLY_STOPPING_THRESHOLD,
+}
+
+
+def emit_event(event, **payload):
+    # Picked out of the log stream by core/trainer.py and sent to the client
+    print("TUNA_EVENT " + json.dumps({"event": event, **payload}, separators=(",", ":")), flush=True)
+
+
+def split_eval(dataset, fraction, seed=42):
+    count = math.ceil(len(dataset) * fraction)
+    if len(dataset) < MIN_EVAL_ROWS or count == 0:
+        return dataset, None
+    order = np.random.default_rng(seed).permutation(len(dataset))
+    return dataset.select(np.sort(order[count:])), dataset.select(np.sort(order[:count]))
 
 
 
 class CustomCallback(TrainerCallback):
     def __init__(self):
-        self.step = 0
+        self.started = None
+        self.epoch_started = None
+        self.epoch_seconds = []
+        # Set once batching is decided, for samples/sec
+        self.examples_per_step = 1
+        self.first_step = 0
+        self.last_step = 0
+        self.last_time = None
+        self.last_tokens = 0
+        self.first_tokens = 0
+        self.first_padded_tokens = 0
+        # Set to the trainer, whose real_tokens_seen leaves out padding
+        self.trainer = None
         
     def log(self, msg):
         print(msg, flush=True)
 
+    def tokens_seen(self):
+        return self.trainer.real_tokens_seen if self.trainer is not None else 0
+
     def on_log(self, args, state: TrainerState, control: TrainerControl, logs: Dict[str, float] = None, **kwargs):
-        if logs is not None:
-            self.step += 1
-            log_str = f"Step {self.step}: "
-            metrics = []
-            for key, value in logs.items():
-                if isinstance(value, (int, float)):
-                    metrics.append(f"{key}: {value:.4f}")
-            log_str += ", ".join(metrics)
-            self.log(log_str)
+        if logs is None:
+            return
+        now = time.time()
+        if "loss" in logs:
+            seconds = max(now - self.last_time, 1e-6)
+            steps = state.global_step - self.last_step
+            step_seconds = (now - self.started) / max(1, state.global_step - self.first_step)
+            emit_event(
+                "metrics",
+                step=state.global_step,
+                epoch=round(state.epoch, 3),
+                loss=logs["loss"],
+                learning_rate=logs.get("learning_rate"),
+                grad_norm=logs.get("grad_norm"),
+                tokens_per_second=round((self.tokens_seen() - self.last_tokens) / seconds, 1),
+                samples_per_second=round(steps * self.examples_per_step / seconds, 2),
+                memory_gb=round(torch.cuda.max_memory_allocated() / 2**30, 2) if torch.cuda.is_available() else None,
+                eta_seconds=round((state.max_steps - state.global_step) * step_seconds)
+            )
+            self.last_step, self.last_time, self.last_tokens = state.global_step, now, self.tokens_seen()
+        elif "eval_loss" in logs:
+            emit_event("eval", step=state.global_step, epoch=round(state.epoch, 3), eval_loss=logs["eval_loss"])
+        else:
+            emit_event("train_summary", **{key: value for key, value in logs.items() if isinstance(value, (int, float))})
     
     def on_init_end(self, args, state: TrainerState, control: TrainerControl, **kwargs):
         self.log("Initialization completed")
         return control
 
     def on_train_begin(self, args, state: TrainerState, control: TrainerControl, **kwargs):
+        self.started = self.last_time = time.time()
+        # A resumed run starts part way through
+        self.first_step = self.last_step = state.global_step
+        self.first_tokens = self.last_tokens = self.tokens_seen()
+        self.first_padded_tokens = state.num_input_tokens_seen
         self.log("Training started")
         return control
 
+    def on_epoch_begin(self, args, state: TrainerState, control: TrainerControl, **kwargs):
+        self.epoch_started = time.time()
+        return control
+
+    def on_epoch_end(self, args, state: TrainerState, control: TrainerControl, **kwargs):
+        self.epoch_seconds.append(time.time() - self.epoch_started)
+        self.log(f"Epoch {state.epoch:.0f} finished after {time.time() - self.started:.1f}s")
+        return control
+
     def on_train_end(self, args, state: TrainerState, control: TrainerControl, **kwargs):
+        elapsed = time.time() - self.started
+        # Real tokens only: num_input_tokens_seen includes padding, which
+        # micro-batches and packed blocks both add
+        tokens = self.tokens_seen() - self.first_tokens
+        self.log(f"Trained on {tokens} tokens in {elapsed:.1f}s ({tokens / elapsed:.1f} tokens/s, "
+                 f"{state.num_input_tokens_seen - self.first_padded_tokens} with padding)")
         self.log("Training completed")
         return control
 
@@ -65,16 +183,6 @@ def main():
     torch.cuda.empty_cache()
 
     try:
-        # Load Dataset
-        logger.log("Loading dataset...")
-        train_dataset = load_dataset(
-            'json', 
-            data_files='/home/ubuntu/runway/dataset.jsonl', 
-            split='train'
-        )
-        logger.log(f"Loaded dataset with {len(train_dataset)} examples")
-        logger.log(f"Dataset features: {train_dataset.features}")
-
         # Load Tokenizer
         logger.log("Loading tokenizer...")
         model_name = MODEL
@@ -82,40 +190,47 @@ def main():
         tokenizer.pad_token = tokenizer.eos_token
         logger.log("Tokenizer loaded successfully")
 
-        # Modified tokenization approach
-        logger.log("Starting dataset tokenization...")
-        def tokenize_function(examples):
-            prompts = []
-            for i in range(len(examples['input'])):
-                prompt = f"input: {examples['input'][i]}\noutput: {examples['output'][i]}"
-                prompts.append(prompt)
-            
-            return tokenizer(
-                prompts,
-                truncation=True,
-                max_length=128,
-                padding=False,
-                return_tensors=None
-            )
+        # Load the tokenized dataset, tokenizing only if this dataset,
+        # tokenizer and max_length have not been seen before
+        logger.log("Loading dataset...")
+        train_dataset = load_tokenized(
+            os.path.join(RUNWAY_DIR, 'dataset.jsonl'),
+            tokenizer,
+            PROMPT_TEMPLATE,
+            MAX_LENGTH,
+            os.path.join(RUNWAY_DIR, 'token_cache'),
+            log=logger.log
+        )
+        logger.log(f"Loaded dataset with {len(train_dataset)} examples ({int(train_dataset.lengths.sum())} tokens)")
 
-        # Process dataset
-        train_dataset = train_dataset.map(
-            tokenize_function,
-            batched=True,
-            batch_size=8,
-            remove_columns=train_dataset.column_names,
-            desc="Tokenizing dataset"
+        plan = plan_run(
+            OUTPUT_DIR,
+            os.path.join(RUNWAY_DIR, 'dataset.jsonl'),
+            TRAINING_SETTINGS,
+            incremental=INCREMENTAL,
+            log=logger.log
         )
+        if plan["nothing_to_do"]:
+            print("Training completed successfully.", flush=True)
+            return
+        rows = len(train_dataset)
+        if plan["start_row"]:
+            train_dataset = train_dataset.tail(plan["start_row"])
+            logger.log(f"Training on the {len(train_dataset)} new examples")
 
-        # Set the format after tokenization
-        train_dataset.set_format(type="torch")
-        logger.log("Dataset tokenization complete")
+        train_dataset, eval_dataset = split_eval(train_dataset, EVAL_FRACTION)
+        if eval_dataset is not None:
+            logger.log(f"Holding out {len(eval_dataset)} examples for evaluation")
+        else:
+            logger.log("Too few examples to hold any out, early stopping is off")
 
-        # Data Collator
-        data_collator = DataCollatorForLanguageModeling(
-            tokenizer=tokenizer,
-            mlm=False
-        )
+        if PACKING:
+            example_count = len(train_dataset)
+            train_dataset = pack_examples(train_dataset.sequences(), PACK_LENGTH, tokenizer.eos_token_id)
+            if eval_dataset is not None:
+                eval_dataset = pack_examples(eval_dataset.sequences(), PACK_LENGTH, tokenizer.eos_token_id)
+            logger.log(f"Packed {example_count} examples into {len(train_dataset)} blocks of up to {PACK_LENGTH} tokens")
+        logger.log("Dataset tokenization complete")
 
         # Load Base Model
         logger.log("Loading base model with memory optimizations...")
@@ -127,6 +242,15 @@ def main():
         )
         logger.log("Base model loaded successfully")
 
+        # Data Collator
+        if PACKING:
+            data_collator = PackedCollator(tokenizer.pad_token_id, dtype=base_model.dtype)
+        else:
+            data_collator = DataCollatorForLanguageModeling(
+                tokenizer=tokenizer,
+                mlm=False
+            )
+
         # Configure LoRA
         logger.log("Configuring LoRA...")
         peft_config = LoraConfig(
@@ -138,7 +262,11 @@ def main():
             target_modules=["q_proj", "v_proj"]
         )
 
-        peft_model = get_peft_model(base_model, peft_config)
+        if plan["init_adapter"]:
+            logger.log("Continuing from the existing adapter...")
+            peft_model = PeftModel.from_pretrained(base_model, OUTPUT_DIR, is_trainable=True)
+        else:
+            peft_model = get_peft_model(base_model, peft_config)
         
         if hasattr(peft_model, "enable_input_require_grads"):
             peft_model.enable_input_require_grads()
@@ -147,16 +275,58 @@ def main():
         trainable_params = sum(p.numel() for p in peft_model.parameters() if p.requires_grad)
         logger.log(f"PEFT model prepared with {trainable_params} trainable parameters")
 
+        # Find (or look up) the largest micro-batch that fits on this GPU
+        seq_len = PACK_LENGTH if PACKING else MAX_LENGTH
+        micro_batch = None
+        if PROBE_BATCH_SIZE:
+            micro_batch = probe_micro_batch(
+                peft_model,
+                MODEL,
+                seq_len,
+                os.path.join(RUNWAY_DIR, "probe_cache.json"),
+                settings=f"r={peft_config.r},targets={','.join(sorted(peft_config.target_modules))}",
+                log=logger.log
+            )
+
+        batch_size = 1
+        batch_sampler = None
+        gradient_accumulation_steps = EXAMPLES_PER_STEP
+        max_batch_tokens = MAX_BATCH_TOKENS
+        if max_batch_tokens == "auto":
+            max_batch_tokens = micro_batch * seq_len if micro_batch else None
+        if max_batch_tokens:
+            if PACKING:
+                lengths = [len(ids) for ids in train_dataset["input_ids"]]
+            else:
+                lengths = train_dataset.lengths.tolist()
+            batch_sampler = TokenBudgetBatchSampler(lengths, max_batch_tokens)
+            gradient_accumulation_steps = max(1, round(EXAMPLES_PER_STEP / batch_sampler.examples_per_batch()))
+            logger.log(f"Token budget {max_batch_tokens}: {len(batch_sampler)} batches of {batch_sampler.examples_per_batch():.1f} examples on average, accumulating {gradient_accumulation_steps} per step")
+        elif micro_batch:
+            # Spend the memory on fewer accumulation steps, not a bigger
+            # effective batch
+            batch_size = min(micro_batch, EXAMPLES_PER_STEP)
+            gradient_accumulation_steps = math.ceil(EXAMPLES_PER_STEP / batch_size)
+            logger.log(f"Micro-batch {batch_size}, accumulating {gradient_accumulation_steps} per step")
+
+        if batch_sampler is not None:
+            logger.examples_per_step = batch_sampler.examples_per_batch() * gradient_accumulation_steps
+        else:
+            logger.examples_per_step = batch_size * gradient_accumulation_steps
+
         # Training Arguments
         logger.log("Setting up training arguments...")
         training_args = TrainingArguments(
-            output_dir="runway_lora",
+            output_dir=OUTPUT_DIR,
             overwrite_output_dir=True,
-            num_train_epochs=20,
-            per_device_train_batch_size=1,
-            gradient_accumulation_steps=4,
-            learning_rate=5e-5,
-            eval_strategy="no",  # Updated from evaluation_strategy
+            num_train_epochs=NUM_EPOCHS,
+            per_device_train_batch_size=batch_size,
+            gradient_accumulation_steps=gradient_accumulation_steps,
+            learning_rate=LEARNING_RATE,
+            eval_strategy="epoch" if eval_dataset is not None else "no",
+            load_best_model_at_end=eval_dataset is not None,
+            metric_for_best_model="eval_loss",
+            greater_is_better=False,
             logging_strategy="steps",
             logging_steps=1,
             save_strategy="epoch",
@@ -165,22 +335,53 @@ def main():
             optim="adamw_torch_fused",
             gradient_checkpointing=True,
             max_grad_norm=0.3,
+            include_num_input_tokens_seen=True,
+            # Progress goes out as metrics events instead
+            disable_tqdm=True,
+            # The packed collator needs the `lengths` column
+            remove_unused_columns=not PACKING,
         )
 
+        callbacks = [logger]
+        if eval_dataset is not None:
+            callbacks.append(EarlyStoppingCallback(
+                early_stopping_patience=EARLY_STOPPING_PATIENCE,
+                early_stopping_threshold=EARLY_STOPPING_THRESHOLD
+            ))
+
         # Create Trainer and Train
-        trainer = Trainer(
+        trainer = TokenBudgetTrainer(
             model=peft_model,
             args=training_args,
             train_dataset=train_dataset,
+            eval_dataset=eval_dataset,
             data_collator=data_collator,
-            callbacks=[logger]
+            callbacks=callbacks,
+            batch_sampler=batch_sampler
         )
+        logger.trainer = trainer
 
         logger.log("Starting model training...")
-        trainer.train()
+        start_run(OUTPUT_DIR, plan, rows)
+        trainer.train(resume_from_checkpoint=plan["resume_from"])
         
         logger.log("Training complete, saving model...")
         trainer.save_model()
+        finish_run(OUTPUT_DIR)
+
+        state = trainer.state
+        stopped_early = state.global_step < state.max_steps
+        epoch_seconds = sum(logger.epoch_seconds) / max(1, len(logger.epoch_seconds))
+        gpu_hours_saved = (NUM_EPOCHS - state.epoch) * epoch_seconds * max(1, torch.cuda.device_count()) / 3600 if stopped_early else 0.0
+        emit_event(
+            "training_stopped",
+            reason="plateau" if stopped_early else "max_epochs",
+            epochs=round(state.epoch, 2),
+            max_epochs=NUM_EPOCHS,
+            best_eval_loss=state.best_metric,
+            best_checkpoint=os.path.basename(state.best_model_checkpoint) if state.best_model_checkpoint else None,
+            gpu_hours_saved=round(gpu_hours_saved, 4)
+        )
         
         print("Training completed successfully.", flush=True)
 
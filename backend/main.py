@@ -1,17 +1,27 @@
-import asyncio, paramiko, json, time
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+import asyncio, math, time
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from dotenv import load_dotenv  
 from pathlib import Path
 from os import getenv
 from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse, StreamingResponse
 from core.response import respond
+from core.warmup import cancel_warm_up
+from core.inference import create_completion, stream_completion
 from sdks.hf import get_models, get_model
+from util.response_cache import response_cache
+from util.admission import admission, Overloaded
+from util.ssh_pool import pool as ssh_pool
 from util.dtypes import WSRequest, ChatCompletionRequest, ChatCompletionResponse, Message
-from util.helpers import stream_from_ssh
 from fastapi.middleware.cors import CORSMiddleware
 
 load_dotenv(Path(__file__).parent / ".env")
 
+admission.configure(
+    max_concurrent=int(getenv("INFERENCE_MAX_CONCURRENT", "16")),
+    max_queue=int(getenv("INFERENCE_MAX_QUEUE", "64")),
+    max_wait=float(getenv("INFERENCE_MAX_WAIT", "30")),
+)
+
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
@@ -40,39 +50,97 @@ async def get_dataset():
     
 
 
+def overloaded_response(e: Overloaded) -> JSONResponse:
+    return JSONResponse(
+        {"error": {"message": str(e), "type": "overloaded"}},
+        status_code=429,
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+
+class SlotStreamingResponse(StreamingResponse):
+    # The admission slot is held until the last event is out, not just until
+    # headers are. It is released when the response is done however that
+    # happens, including a client that left before the body was iterated
+    def __init__(self, content, **kwargs):
+        super().__init__(content, **kwargs)
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            admission.release(time.monotonic() - self.started)
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+
+def bad_request(message: str) -> JSONResponse:
+    return JSONResponse({"error": {"message": message, "type": "invalid_request_error"}}, status_code=400)
+
+
 @app.post("/v1/chat/completions")
-async def create_chat_completion(request: ChatCompletionRequest):
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+async def create_chat_completion(request: ChatCompletionRequest, http_request: Request):
+    # Optional X-Priority (lower is served first) and X-Queue-Timeout
+    # (seconds to wait for a slot before giving up with a 429)
     try:
-        ssh.connect(
-            hostname=getenv("SSH_HOST_H100"),
-            username="ubuntu",
-            key_filename=getenv("SSH_KEY_PATH")
-        )
+        priority = int(http_request.headers.get("x-priority", 0))
+        queue_timeout = http_request.headers.get("x-queue-timeout")
+        queue_timeout = float(queue_timeout) if queue_timeout else None
+        if queue_timeout is not None and not (math.isfinite(queue_timeout) and queue_timeout >= 0):
+            raise ValueError(queue_timeout)
+    except ValueError:
+        return bad_request("X-Priority must be an integer and X-Queue-Timeout a non-negative number of seconds")
 
-        command = (
-            'source /home/ubuntu/runway/.venv/bin/activate && '
-            'python3 /home/ubuntu/runway/output.py'
+    if request.stream:
+        try:
+            await admission.acquire(priority, queue_timeout)
+        except Overloaded as e:
+            return overloaded_response(e)
+        return SlotStreamingResponse(
+            stream_completion(request.dict()),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
         )
-        stdin, stdout, stderr = ssh.exec_command(command)
-        
-        json_request = json.dumps(request.dict())
-        stdin.write(json_request)
-        stdin.channel.shutdown_write()
-        
-        output = stdout.read().decode("utf-8")
-        # print(f"<<{output.strip()}>>")
-        ssh.close()
-        
-        response_data = json.loads(output)
+
+    payload = request.dict()
+
+    async def generate() -> dict:
+        # Cache hits and coalesced duplicates never take a slot
+        async with admission.slot(priority, queue_timeout):
+            # Forwarded to the warm output.py --serve daemon instead of
+            # spawning a fresh interpreter (and model load) per request
+            response_data = await create_completion(payload)
         # print(f"<<{response_data}>>")
-        return JSONResponse(response_data)
+        if "error" in response_data:
+            raise Exception(response_data["error"]["message"])
+        return response_data
+
+    try:
+        cache_key = response_cache.key(payload)
+        if cache_key is None:
+            return JSONResponse(await generate())
+        return JSONResponse(await response_cache.get_or_create(cache_key, generate))
+    except Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/metrics")
+async def get_metrics():
+    return JSONResponse({
+        "admission": admission.stats(),
+        "response_cache": response_cache.stats(),
+        "ssh_pool": ssh_pool.stats()
+    }, status_code=200)
+
+
 
 @app.websocket("/wsc")
 async def websocket_endpoint(websocket: WebSocket):
@@ -82,13 +150,30 @@ async def websocket_endpoint(websocket: WebSocket):
     active_socket = websocket
     print("WebSocket connection established")
 
+    # The next message is always being awaited, even while a request is
+    # being handled, so a disconnect mid-training is noticed straight away
+    # and the work (and whatever it is running remotely) is cancelled
+    incoming = asyncio.ensure_future(websocket.receive_json())
+    work = None
     try:
         while True:
-            data = await websocket.receive_json()
-            data = WSRequest(**data)
-            await respond(data, websocket.send_json)
+            data = WSRequest(**(await incoming))
+            incoming = asyncio.ensure_future(websocket.receive_json())
+            work = asyncio.ensure_future(respond(data, websocket.send_json))
+            await asyncio.wait({work, incoming}, return_when=asyncio.FIRST_COMPLETED)
+            if not work.done() and incoming.exception() is not None:
+                await incoming
+            await work
     except WebSocketDisconnect:
         print("WebSocket disconnected")
     finally:
+        for task in (incoming, work):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        cancel_warm_up()
         active_socket = None
 
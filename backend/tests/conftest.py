@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# Tests import the API modules, the bench helpers, and (through bench/tiny.py)
+# the scripts that get shipped to the GPU host
+BACKEND = Path(__file__).parent.parent
+sys.path.insert(0, str(BACKEND / "bench"))
+sys.path.insert(0, str(BACKEND))
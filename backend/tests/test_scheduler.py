@@ -0,0 +1,47 @@
+import json
+import socket
+import threading
+import time
+from tiny import tiny_model, tiny_tokenizer
+from scheduler import BatchScheduler
+from output import ModelServer
+
+
+def wait_for(condition, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_abandoned_stream_frees_its_slot():
+    tokenizer = tiny_tokenizer()
+    # No EOS, so only max_tokens or a cancel can end the request
+    scheduler = BatchScheduler(tiny_model(hidden_size=64, layers=2, heads=4), eos_token_id=None).start()
+    server = ModelServer(("127.0.0.1", 0), scheduler, tokenizer, "tiny")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        client = socket.create_connection(server.server_address)
+        request = {"messages": [{"role": "user", "content": "hi"}], "max_tokens": 4000, "temperature": 0.7, "stream": True}
+        client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        reader = client.makefile("rb")
+        for _ in range(3):
+            assert reader.readline()
+        assert scheduler.stats()["active"] == 1
+
+        # Hang up mid-stream; the next write fails and the request is retired
+        reader.close()
+        client.shutdown(socket.SHUT_RDWR)
+        client.close()
+
+        assert wait_for(lambda: scheduler.stats()["active"] == 0)
+        stats = scheduler.stats()
+        assert stats["cancelled"] == 1
+        assert stats["generated_tokens"] < 4000
+    finally:
+        server.shutdown()
+        server.server_close()
+        scheduler.stop()
@@ -0,0 +1,77 @@
+import threading
+import time
+from util.ssh_pool import SSHPool, PooledConnection
+
+
+class FakeTransport:
+    def is_active(self):
+        return True
+
+    def send_ignore(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return None if self.closed else self.transport
+
+    def close(self):
+        self.closed = True
+
+
+def stub_connect(pool, delay=0.2):
+    opened = []
+
+    def connect(host, username, key_filename):
+        time.sleep(delay)
+        conn = PooledConnection(FakeClient())
+        opened.append(conn)
+        return conn
+
+    pool._connect = connect
+    return opened
+
+
+def test_cold_burst_respects_max_per_host():
+    pool = SSHPool(max_per_host=2, channels_per_transport=8)
+    opened = stub_connect(pool)
+    leased, errors = [], []
+    start = threading.Barrier(16)
+
+    def lease():
+        try:
+            start.wait()
+            with pool.connection("gpu-host") as client:
+                leased.append(client)
+                time.sleep(0.1)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=lease) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert len(leased) == 16
+    assert len(opened) <= 2
+    assert pool.stats()["ubuntu@gpu-host"]["transports"] <= 2
+    assert pool.stats()["ubuntu@gpu-host"]["leases"] == 0
+
+
+def test_release_closes_idle_transports_above_the_bound():
+    pool = SSHPool(max_per_host=2)
+    key = ("gpu-host", "ubuntu", None)
+    conns = [PooledConnection(FakeClient()) for _ in range(4)]
+    pool._hosts[key] = list(conns)
+    conns[0].leases = 1
+
+    pool._release("gpu-host", "ubuntu", None, conns[0])
+
+    assert pool.stats()["ubuntu@gpu-host"]["transports"] == 2
+    assert sum(conn.client.closed for conn in conns) == 2
@@ -0,0 +1,24 @@
+import asyncio
+import json
+import core.trainer as trainer
+from util.remote import LocalRemote
+
+
+def test_log_lines_flush_the_open_metrics_window(tmp_path):
+    metrics = {"event": "metrics", "step": 1, "epoch": 0.1, "loss": 1.5}
+    command = (
+        f"echo 'TUNA_EVENT {json.dumps(metrics)}'; "
+        f"echo 'TUNA_EVENT {json.dumps({**metrics, 'step': 2, 'loss': 1.25})}'; "
+        "echo 'Train script finished!'"
+    )
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(trainer.run_command(LocalRemote(str(tmp_path)), command, send))
+
+    assert [("metrics" in message, message["log"].split(">> ", 1)[1].strip()) for message in messages] == [
+        (True, "Steps 1-2: loss: 1.3750"),
+        (False, "Train script finished!"),
+    ]
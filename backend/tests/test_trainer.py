@@ -0,0 +1,42 @@
+import asyncio
+import os
+import shutil
+import core.trainer as trainer
+from util.sync import SyncReport
+
+RUN_SH = os.path.join(os.path.dirname(__file__), "..", "data", "run.sh")
+
+
+def test_failed_training_is_not_reported_complete(tmp_path, monkeypatch):
+    # A local stand-in for the GPU host whose train_script.py crashes
+    runway = tmp_path / "runway"
+    (runway / ".venv" / "bin").mkdir(parents=True)
+    (runway / ".venv" / "bin" / "activate").write_text("")
+    (runway / "train_script.py").write_text("import sys\nprint('training...')\nsys.exit(3)\n")
+    (runway / "output.py").write_text("open('materialized', 'w').close()\n")
+    shutil.copy(RUN_SH, runway / "run.sh")
+    os.chmod(runway / "run.sh", 0o755)
+
+    monkeypatch.setenv("REMOTE_BACKEND", "local")
+    monkeypatch.setenv("LOCAL_REMOTE_HOME", str(tmp_path))
+
+    async def synced(*args):
+        return SyncReport()
+
+    async def nothing(*args):
+        return True
+
+    monkeypatch.setattr(trainer, "sync_files", synced)
+    monkeypatch.setattr(trainer, "ensure_environment", nothing)
+    monkeypatch.setattr(trainer, "stop_model_server", nothing)
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(trainer.train_model_response(None, send))
+
+    assert not any(message["complete"] for message in messages)
+    assert any("exited with status 3" in message["log"] for message in messages)
+    assert not (runway / "materialized").exists()
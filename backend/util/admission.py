@@ -0,0 +1,118 @@
+import asyncio, heapq, itertools, math, time
+from contextlib import asynccontextmanager
+
+#### ADMISSION CONTROL FOR /v1/chat/completions
+#
+# At most `max_concurrent` completions are in flight to the model host; the
+# scheduler there batches them, and anything beyond that only adds latency
+# for everyone. Requests over the limit wait in a bounded queue ordered by
+# priority (lower first) then arrival. A request is turned away with a 429
+# as soon as the queue is full, or once it has waited longer than its
+# deadline, so a burst fails fast instead of timing out everywhere.
+
+class Overloaded(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent: int = 16, max_queue: int = 64, max_wait: float = 30.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._queue: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_deadline = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        # Moving average of how long a slot is held, for Retry-After
+        self.service_seconds = 1.0
+
+    def configure(self, max_concurrent: int, max_queue: int, max_wait: float) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._wake()
+
+    def retry_after(self) -> int:
+        # Roughly how long until the current backlog drains
+        backlog = len(self._queue) + 1
+        return max(1, math.ceil(self.service_seconds * backlog / max(1, self.max_concurrent)))
+
+    def _wake(self) -> None:
+        while self._queue and self.active < self.max_concurrent:
+            _, _, waiter = heapq.heappop(self._queue)
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    async def acquire(self, priority: int = 0, timeout: float | None = None) -> None:
+        started = time.monotonic()
+        if self.active < self.max_concurrent and not self._queue:
+            self.active += 1
+        else:
+            if len(self._queue) >= self.max_queue:
+                self.rejected_full += 1
+                raise Overloaded("Inference queue is full", self.retry_after())
+
+            waiter = asyncio.get_running_loop().create_future()
+            entry = (priority, next(self._order), waiter)
+            heapq.heappush(self._queue, entry)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), timeout if timeout is not None else self.max_wait)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if entry in self._queue:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                elif waiter.done() and not waiter.cancelled():
+                    # Granted in the same tick the deadline fired or the caller left
+                    self.release()
+                waiter.cancel()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self.rejected_deadline += 1
+                raise Overloaded("Timed out waiting for an inference slot", self.retry_after())
+
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def release(self, held: float | None = None) -> None:
+        self.active -= 1
+        if held is not None:
+            self.service_seconds = 0.9 * self.service_seconds + 0.1 * held
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0, timeout: float | None = None):
+        await self.acquire(priority, timeout)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": len(self._queue),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "max_wait": self.max_wait,
+            "admitted": self.admitted,
+            "rejected_full": self.rejected_full,
+            "rejected_deadline": self.rejected_deadline,
+            "avg_wait_ms": round(1000 * self.wait_seconds / self.admitted, 2) if self.admitted else 0.0,
+            "max_wait_ms": round(1000 * self.max_wait_seconds, 2),
+            "avg_service_ms": round(1000 * self.service_seconds, 2),
+            "retry_after": self.retry_after(),
+        }
+
+
+admission = AdmissionController()
@@ -53,7 +53,8 @@ class ChatCompletionRequest(BaseModel):
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
     max_tokens: Optional[int] = 1000
-    stream: Optional[bool] = True
+    stream: Optional[bool] = False
+    stop: Optional[str | List[str]] = None
 
 class ChatCompletionResponse(BaseModel):
     id: str = Field(default="chatcmpl-default")
@@ -95,11 +96,40 @@ class TrainInstanceSelection(BaseModel):
     text: str 
     instances: list[dict]
 
+class TrainMetrics(BaseModel):
+    # One `metrics` event from train_script.py, i.e. one optimizer step
+    step: int
+    epoch: float
+    loss: float
+    learning_rate: Optional[float] = None
+    grad_norm: Optional[float] = None
+    tokens_per_second: Optional[float] = None
+    samples_per_second: Optional[float] = None
+    memory_gb: Optional[float] = None
+    eta_seconds: Optional[float] = None
+
+class TrainMetricsWindow(BaseModel):
+    # Steps first_step..last_step folded into one client update
+    first_step: int
+    last_step: int
+    points: int
+    epoch: float
+    loss: float
+    min_loss: float
+    learning_rate: Optional[float] = None
+    grad_norm: Optional[float] = None
+    tokens_per_second: Optional[float] = None
+    samples_per_second: Optional[float] = None
+    memory_gb: Optional[float] = None
+    eta_seconds: Optional[float] = None
+
 class TrainDetails(BaseModel):
     type: str
     text: str 
     log: str 
     complete: bool = False
+    metrics: Optional[TrainMetricsWindow] = None
+    event: Optional[dict] = None
 
 class Deployment(BaseModel):
     type: str
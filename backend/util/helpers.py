@@ -1,7 +1,6 @@
-import json, asyncio
+import json, asyncio, socket
 from datetime import datetime
-from fastapi.responses import JSONResponse
-from fastapi import HTTPException
+from util.remote import in_thread
 
 def make_json_serializable(data):
     if isinstance(data, dict):
@@ -25,33 +24,44 @@ def get_log_format(msg: str, tuna_msg: bool = False):
 
 
 
-async def stream_from_ssh(ssh_client, channel, request_data):
+async def stream_from_ssh(channel, request_data):
+    # paramiko exposes a pipe fd that becomes readable whenever the channel
+    # buffers data (or closes), so the event loop wakes us instead of polling.
+    # A plain socket (the local remote) works the same way
+    loop = asyncio.get_running_loop()
+    readable = asyncio.Event()
+    # The channel is still blocking here, and a large prompt can wait on the
+    # SSH window, so the send runs on the remote executor
+    await in_thread(channel.sendall, (json.dumps(request_data) + "\n").encode("utf-8"))
+    channel.setblocking(False)
+    fd = channel.fileno()
+    loop.add_reader(fd, readable.set)
+
     try:
-        # Send request to the model server
-        print("HERE2")
-        channel.send(json.dumps(request_data) + "\n")
-        print("HERE")
-        
-        buffer = ""
+        buffer = b""
         while True:
-            if channel.recv_ready():
-                chunk = channel.recv(4096).decode('utf-8')
-                buffer += chunk
-                
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    print(line)
-                    try:
-                        response = json.loads(line)
-                        if "error" in response:
-                            raise Exception(response["error"]["message"])
-                        yield f"data: {json.dumps(response)}\n\n"
-                    except json.JSONDecodeError:
-                        continue
-                        
-            await asyncio.sleep(0.01)
-            
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    
-    yield "data: [DONE]\n\n"
\ No newline at end of file
+            try:
+                chunk = channel.recv(65536)
+            except (socket.timeout, BlockingIOError):
+                readable.clear()
+                await readable.wait()
+                continue
+
+            if not chunk:
+                yield f"data: {json.dumps({'error': {'message': 'Model server closed the stream', 'type': 'internal_error'}})}\n\n"
+                break
+
+            buffer += chunk
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                line = line.decode("utf-8").strip()
+                if not line:
+                    continue
+                if line == "[DONE]":
+                    yield "data: [DONE]\n\n"
+                    return
+                # Error payloads are relayed as-is since headers are already sent
+                yield f"data: {line}\n\n"
+    finally:
+        loop.remove_reader(fd)
+        channel.close()
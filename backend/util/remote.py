@@ -0,0 +1,268 @@
+import asyncio, codecs, os, select, shutil, signal, socket, threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from os import getenv
+from typing import Awaitable, Callable
+from util.ssh_pool import pool
+
+#### REMOTE EXECUTION
+#
+# Everything the API does on the training / inference host goes through a
+# remote, so no SSH round trip ever runs on the event loop. SSHRemote drives
+# paramiko from its own thread pool (a slow training log cannot starve
+# asyncio.to_thread users) and hands output lines back through an asyncio
+# queue. LocalRemote is the offline stand-in: the same commands run as local
+# subprocesses with /home/ubuntu mapped to LOCAL_REMOTE_HOME. Set
+# REMOTE_BACKEND=local to use it.
+
+REMOTE_HOME = "/home/ubuntu"
+SSH_USERNAME = "ubuntu"
+
+# Called with ("stdout" | "stderr", line) for every line a command prints
+OnLine = Callable[[str, str], Awaitable[None]]
+
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="remote")
+
+PGID_MARKER = "__TUNA_PGID__ "
+# How long a cancelled command gets after SIGTERM before SIGKILL
+KILL_GRACE_SECONDS = 5
+
+
+class CommandTimeout(TimeoutError):
+    def __init__(self, command: str, timeout: float):
+        super().__init__(f"Command timed out after {timeout:g}s: {command}")
+        self.command = command
+        self.timeout = timeout
+
+
+class LineSplitter:
+    # Turns chunks of bytes into complete lines (newline kept), decoding
+    # UTF-8 that may be split across chunks
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.partial = ""
+
+    def feed(self, data: bytes) -> list[str]:
+        text = self.partial + self.decoder.decode(data)
+        lines = text.split("\n")
+        self.partial = lines.pop()
+        return [line + "\n" for line in lines]
+
+    def flush(self) -> str:
+        rest, self.partial = self.partial + self.decoder.decode(b"", final=True), ""
+        return rest
+
+
+async def in_thread(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, partial(fn, *args))
+
+
+class SSHRemote:
+    def __init__(self, host: str, username: str = SSH_USERNAME, key_filename: str | None = None):
+        self.host = host
+        self.username = username
+        self.key_filename = key_filename
+
+    def lease(self):
+        return pool.connection(self.host, self.username, self.key_filename)
+
+    async def run(self, command: str, on_line: OnLine | None = None, timeout: float | None = None, stdin: bytes | None = None) -> int:
+        loop = asyncio.get_running_loop()
+        lines: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        pgid: list[str] = []
+
+        def pump() -> int:
+            try:
+                with self.lease() as ssh:
+                    # The process group id comes back on the first line so the
+                    # whole command tree can be killed if we give up on it
+                    writer, stdout, _ = ssh.exec_command(f"echo {PGID_MARKER}$(ps -o pgid= -p $$ | tr -d ' '); {command}")
+                    channel = stdout.channel
+                    if stdin is not None:
+                        channel.sendall(stdin)
+                    # Closing the stdin file sends EOF
+                    writer.close()
+                    splitters = {"stdout": LineSplitter(), "stderr": LineSplitter()}
+
+                    def emit(stream: str, data: bytes) -> None:
+                        for line in splitters[stream].feed(data):
+                            if stream == "stdout" and not pgid and line.startswith(PGID_MARKER):
+                                pgid.append(line[len(PGID_MARKER):].strip())
+                                continue
+                            loop.call_soon_threadsafe(lines.put_nowait, (stream, line))
+
+                    # Both streams are read as data arrives, so a chatty
+                    # stderr cannot fill its window and stall the command
+                    while not stop.is_set():
+                        busy = False
+                        if channel.recv_ready():
+                            emit("stdout", channel.recv(32768))
+                            busy = True
+                        if channel.recv_stderr_ready():
+                            emit("stderr", channel.recv_stderr(32768))
+                            busy = True
+                        if not busy:
+                            if channel.eof_received and channel.exit_status_ready():
+                                break
+                            select.select([channel], [], [], 0.5)
+
+                    if stop.is_set():
+                        channel.close()
+                        return -1
+                    for stream, splitter in splitters.items():
+                        if (rest := splitter.flush()):
+                            loop.call_soon_threadsafe(lines.put_nowait, (stream, rest))
+                    return channel.recv_exit_status()
+            finally:
+                loop.call_soon_threadsafe(lines.put_nowait, None)
+
+        async def drain() -> None:
+            while (item := await lines.get()) is not None:
+                if on_line is not None:
+                    await on_line(*item)
+
+        finished = loop.run_in_executor(_executor, pump)
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            await asyncio.shield(self.abort(stop, pgid, finished))
+            raise CommandTimeout(command, timeout)
+        except BaseException:
+            # Cancelled (the client went away) or the line handler failed
+            await asyncio.shield(self.abort(stop, pgid, finished))
+            raise
+        return await finished
+
+    async def abort(self, stop: threading.Event, pgid: list[str], finished: asyncio.Future) -> None:
+        stop.set()
+        if pgid:
+            # TERM now, KILL a little later from a detached shell so this
+            # returns straight away
+            group = pgid[0]
+            await in_thread(self.exec_detached, (
+                f"kill -TERM -- -{group} 2>/dev/null; "
+                f"setsid sh -c 'sleep {KILL_GRACE_SECONDS}; kill -KILL -- -{group} 2>/dev/null' > /dev/null 2>&1 < /dev/null &"
+            ))
+        try:
+            await finished
+        except Exception:
+            pass
+
+    def exec_detached(self, command: str) -> None:
+        with self.lease() as ssh:
+            _, stdout, _ = ssh.exec_command(command)
+            stdout.channel.recv_exit_status()
+
+    async def put(self, source: str, destination: str) -> None:
+        def upload() -> None:
+            with self.lease() as ssh:
+                pool.sftp(ssh).put(source, destination)
+
+        await in_thread(upload)
+
+    @asynccontextmanager
+    async def open_channel(self, host: str, port: int):
+        # A direct-tcpip channel to host:port as seen from the remote machine
+        lease = self.lease()
+        ssh = await in_thread(lease.__enter__)
+        try:
+            channel = await in_thread(ssh.get_transport().open_channel, "direct-tcpip", (host, port), ("127.0.0.1", 0))
+            try:
+                yield channel
+            finally:
+                channel.close()
+        finally:
+            await in_thread(lease.__exit__, None, None, None)
+
+
+class LocalRemote:
+    def __init__(self, home: str):
+        self.home = os.path.abspath(home)
+
+    def local(self, text: str) -> str:
+        return text.replace(REMOTE_HOME, self.home)
+
+    async def run(self, command: str, on_line: OnLine | None = None, timeout: float | None = None, stdin: bytes | None = None) -> int:
+        process = await asyncio.create_subprocess_exec(
+            "/bin/bash", "-c", self.local(command),
+            stdin=asyncio.subprocess.DEVNULL if stdin is None else asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env={**os.environ, "RUNWAY_DIR": os.path.join(self.home, "runway")},
+            # Its own process group, so everything it starts can be killed
+            start_new_session=True,
+        )
+        lines: asyncio.Queue = asyncio.Queue()
+
+        async def read(name: str, stream: asyncio.StreamReader) -> None:
+            async for line in stream:
+                await lines.put((name, line.decode("utf-8", errors="replace")))
+
+        async def write() -> None:
+            if stdin is not None:
+                process.stdin.write(stdin)
+                await process.stdin.drain()
+                process.stdin.close()
+
+        def finished(readers: asyncio.Future) -> None:
+            lines.put_nowait(None)
+            # Marks a cancelled read as seen; real errors surface from drain
+            if not readers.cancelled():
+                readers.exception()
+
+        async def drain() -> None:
+            # Both pipes are read together so neither can fill up and stall
+            # the child; lines are handed on in the order they arrived
+            readers = asyncio.gather(read("stdout", process.stdout), read("stderr", process.stderr), write())
+            readers.add_done_callback(finished)
+            try:
+                while (item := await lines.get()) is not None:
+                    if on_line is not None:
+                        await on_line(*item)
+                await readers
+            finally:
+                readers.cancel()
+
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            await asyncio.shield(self.abort(process))
+            raise CommandTimeout(command, timeout)
+        except BaseException:
+            await asyncio.shield(self.abort(process))
+            raise
+        return await process.wait()
+
+    async def abort(self, process: asyncio.subprocess.Process) -> None:
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            if process.returncode is not None:
+                return
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                return
+            try:
+                await asyncio.wait_for(process.wait(), KILL_GRACE_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def put(self, source: str, destination: str) -> None:
+        destination = self.local(destination)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        await in_thread(shutil.copyfile, source, destination)
+
+    @asynccontextmanager
+    async def open_channel(self, host: str, port: int):
+        channel = await in_thread(socket.create_connection, (host, port))
+        try:
+            yield channel
+        finally:
+            channel.close()
+
+
+def get_remote(host: str | None) -> SSHRemote | LocalRemote:
+    if getenv("REMOTE_BACKEND", "ssh") == "local":
+        return LocalRemote(getenv("LOCAL_REMOTE_HOME", ".remote"))
+    return SSHRemote(host, SSH_USERNAME, getenv("SSH_KEY_PATH"))
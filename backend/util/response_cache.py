@@ -0,0 +1,102 @@
+import asyncio, hashlib, json, time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+#### CHAT COMPLETION RESPONSE CACHE
+#
+# Only deterministic requests (temperature 0, non-streaming) are cacheable,
+# since a sampled completion is not "the" answer to a prompt. Concurrent
+# identical requests are collapsed onto one in-flight generation, and the
+# shared task is shielded so one caller disconnecting does not cancel it for
+# everyone else.
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 512, ttl: float = 600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+        # Bumped by clear() so generations already in flight are not stored
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(payload: dict) -> str | None:
+        if payload.get("stream") or payload.get("temperature") is None or payload["temperature"] > 0:
+            return None
+
+        canonical = {k: v for k, v in payload.items() if k != "stream"}
+        encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def _lookup(self, key: str) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key: str, value: dict) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_create(self, key: str, factory: Callable[[], Awaitable[dict]]) -> dict:
+        cached = self._lookup(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            generation = self._generation
+
+            def settle(done: asyncio.Task) -> None:
+                if self._inflight.get(key) is done:
+                    del self._inflight[key]
+                if generation == self._generation and not done.cancelled() and done.exception() is None:
+                    self._store(key, done.result())
+
+            task.add_done_callback(settle)
+
+        return await asyncio.shield(task)
+
+    def clear(self) -> None:
+        # The served model changed (a new adapter was trained), so every
+        # cached answer is stale
+        self._entries.clear()
+        self._inflight.clear()
+        self._generation += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+        }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,198 @@
+import threading, time, paramiko
+from collections import OrderedDict
+from contextlib import contextmanager
+
+#### SHARED SSH TRANSPORT POOL
+#
+# One authenticated transport can carry many channels (exec sessions, SFTP,
+# direct-tcpip forwards) at once, so callers lease a connection rather than
+# owning it. Transports are only added when every live one for a host is
+# already carrying `channels_per_transport` leases, and never beyond
+# `max_per_host` transports (handshakes in flight included): a burst against
+# a cold host waits for the first handshake instead of opening one each.
+
+class PooledConnection:
+    def __init__(self, client: paramiko.SSHClient):
+        self.client = client
+        self.leases = 0
+        self.sftp: paramiko.SFTPClient | None = None
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.last_checked = self.created
+
+    @property
+    def transport(self) -> paramiko.Transport | None:
+        return self.client.get_transport()
+
+    def is_alive(self, health_interval: float) -> bool:
+        transport = self.transport
+        if transport is None or not transport.is_active():
+            return False
+
+        now = time.monotonic()
+        if now - self.last_checked < health_interval:
+            return True
+
+        try:
+            transport.send_ignore()
+        except (paramiko.SSHException, EOFError, OSError):
+            return False
+        self.last_checked = now
+        return True
+
+    def close(self) -> None:
+        try:
+            if self.sftp is not None:
+                self.sftp.close()
+        finally:
+            self.client.close()
+
+
+class SSHPool:
+    def __init__(
+        self,
+        max_per_host: int = 2,
+        max_hosts: int = 8,
+        channels_per_transport: int = 8,
+        keepalive: int = 30,
+        health_interval: float = 15.0,
+        connect_timeout: float = 15.0,
+    ):
+        self.max_per_host = max_per_host
+        self.max_hosts = max_hosts
+        self.channels_per_transport = channels_per_transport
+        self.keepalive = keepalive
+        self.health_interval = health_interval
+        self.connect_timeout = connect_timeout
+        self._hosts: OrderedDict[tuple, list[PooledConnection]] = OrderedDict()
+        self._owners: dict[int, PooledConnection] = {}
+        self._connecting: dict[tuple, int] = {}
+        self._lock = threading.Lock()
+        # Notified whenever a handshake finishes, successfully or not
+        self._connected = threading.Condition(self._lock)
+
+    def _connect(self, host: str, username: str, key_filename: str | None) -> PooledConnection:
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            hostname=host,
+            username=username,
+            key_filename=key_filename,
+            timeout=self.connect_timeout,
+            banner_timeout=self.connect_timeout,
+        )
+        client.get_transport().set_keepalive(self.keepalive)
+        return PooledConnection(client)
+
+    def _drop(self, key: tuple, conn: PooledConnection) -> None:
+        conns = self._hosts.get(key, [])
+        if conn in conns:
+            conns.remove(conn)
+        self._owners.pop(id(conn.client), None)
+        conn.close()
+
+    def _evict_hosts(self) -> None:
+        # Least recently used hosts go first, but never one with leases out
+        while len(self._hosts) > self.max_hosts:
+            idle = next((k for k, conns in self._hosts.items() if all(c.leases == 0 for c in conns)), None)
+            if idle is None:
+                return
+            for conn in self._hosts.pop(idle):
+                self._owners.pop(id(conn.client), None)
+                conn.close()
+
+    def _acquire(self, host: str, username: str, key_filename: str | None) -> PooledConnection:
+        key = (host, username, key_filename)
+        with self._lock:
+            while True:
+                conns = self._hosts.setdefault(key, [])
+                self._hosts.move_to_end(key)
+
+                for conn in [c for c in conns if not c.is_alive(self.health_interval)]:
+                    self._drop(key, conn)
+
+                live = sorted(conns, key=lambda c: c.leases)
+                total = len(live) + self._connecting.get(key, 0)
+                if live and (live[0].leases < self.channels_per_transport or total >= self.max_per_host):
+                    conn = live[0]
+                    conn.leases += 1
+                    conn.last_used = time.monotonic()
+                    return conn
+                if total < self.max_per_host:
+                    self._connecting[key] = self._connecting.get(key, 0) + 1
+                    break
+                # Nothing live yet and the limit is all handshakes in flight
+                self._connected.wait(self.connect_timeout)
+
+        # Handshake outside the lock so other hosts are not held up by it
+        try:
+            conn = self._connect(host, username, key_filename)
+        except BaseException:
+            with self._lock:
+                self._connecting[key] -= 1
+                self._connected.notify_all()
+            raise
+
+        conn.leases += 1
+        with self._lock:
+            self._connecting[key] -= 1
+            self._hosts.setdefault(key, []).append(conn)
+            self._hosts.move_to_end(key)
+            self._owners[id(conn.client)] = conn
+            self._evict_hosts()
+            self._connected.notify_all()
+        return conn
+
+    def _release(self, host: str, username: str, key_filename: str | None, conn: PooledConnection) -> None:
+        key = (host, username, key_filename)
+        with self._lock:
+            conn.leases -= 1
+            conn.last_used = time.monotonic()
+            transport = conn.transport
+            if transport is None or not transport.is_active():
+                self._drop(key, conn)
+
+            # Trim idle transports above the bound, least recently used first
+            conns = self._hosts.get(key, [])
+            for idle in sorted((c for c in conns if c.leases == 0), key=lambda c: c.last_used):
+                if len(conns) <= self.max_per_host:
+                    break
+                self._drop(key, idle)
+
+    @contextmanager
+    def connection(self, host: str, username: str = "ubuntu", key_filename: str | None = None):
+        conn = self._acquire(host, username, key_filename)
+        try:
+            yield conn.client
+        finally:
+            self._release(host, username, key_filename, conn)
+
+    def sftp(self, client: paramiko.SSHClient) -> paramiko.SFTPClient:
+        with self._lock:
+            conn = self._owners.get(id(client))
+            if conn is None:
+                return client.open_sftp()
+            if conn.sftp is None or conn.sftp.get_channel().closed:
+                conn.sftp = client.open_sftp()
+            return conn.sftp
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                f"{username}@{host}": {
+                    "transports": len(conns),
+                    "leases": sum(c.leases for c in conns),
+                }
+                for (host, username, _), conns in self._hosts.items()
+            }
+
+    def close_all(self) -> None:
+        with self._lock:
+            for conns in self._hosts.values():
+                for conn in conns:
+                    conn.close()
+            self._hosts.clear()
+            self._owners.clear()
+
+
+pool = SSHPool()
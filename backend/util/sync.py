@@ -0,0 +1,109 @@
+import hashlib, io, os, shlex, tarfile, time
+from dataclasses import dataclass, field
+from util.remote import SSHRemote, LocalRemote
+
+#### ARTIFACT SYNC
+#
+# Ships a set of local files into one directory on the remote in two round
+# trips. First the remote reports a manifest of what it already has (sha256
+# and mode of each file). Then everything that differs goes over as a single
+# gzipped tar stream on the stdin of `tar -x`, with the wanted permissions
+# stored in the archive, so there is no SFTP session per file and no chmod
+# afterwards.
+
+
+@dataclass
+class SyncReport:
+    sent: list[str] = field(default_factory=list)
+    unchanged: list[str] = field(default_factory=list)
+    total_bytes: int = 0
+    sent_bytes: int = 0
+    compressed_bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.total_bytes - self.compressed_bytes
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def remote_manifest(remote: SSHRemote | LocalRemote, destination: str, names: list[str]) -> dict[str, tuple[str, int]]:
+    # "<sha256> <octal mode> <name>" for every file that exists
+    script = (
+        f"cd {shlex.quote(destination)} 2>/dev/null || exit 0; "
+        f"for f in {' '.join(shlex.quote(name) for name in names)}; do "
+        '[ -f "$f" ] && echo "$(sha256sum < "$f" | cut -d" " -f1) $(stat -c %a "$f") $f"; '
+        "done; true"
+    )
+    lines = []
+
+    async def collect(stream: str, line: str) -> None:
+        if stream == "stdout":
+            lines.append(line.strip())
+
+    await remote.run(script, collect, timeout=60)
+    manifest = {}
+    for line in lines:
+        parts = line.split(" ", 2)
+        if len(parts) == 3:
+            manifest[parts[2]] = (parts[0], int(parts[1], 8))
+    return manifest
+
+
+def bundle(files: dict[str, tuple[str, int]]) -> tuple[bytes, int]:
+    buffer, size = io.BytesIO(), 0
+    with tarfile.open(fileobj=buffer, mode="w:gz", compresslevel=6) as tar:
+        for name, (source, mode) in files.items():
+            info = tar.gettarinfo(source, arcname=name)
+            info.mode = mode
+            info.uid = info.gid = 0
+            info.uname = info.gname = ""
+            size += info.size
+            with open(source, "rb") as f:
+                tar.addfile(info, f)
+    return buffer.getvalue(), size
+
+
+async def sync_files(remote: SSHRemote | LocalRemote, files: dict[str, tuple[str, int]], destination: str) -> SyncReport:
+    # `files` maps the name in `destination` to (local path, mode)
+    started = time.monotonic()
+    report = SyncReport(total_bytes=sum(os.path.getsize(source) for source, _ in files.values()))
+    existing = await remote_manifest(remote, destination, list(files))
+
+    changed = {}
+    for name, (source, mode) in files.items():
+        if existing.get(name) == (file_sha256(source), mode):
+            report.unchanged.append(name)
+        else:
+            changed[name] = (source, mode)
+
+    if changed:
+        archive, report.sent_bytes = bundle(changed)
+        report.compressed_bytes = len(archive)
+        errors = []
+
+        async def collect(stream: str, line: str) -> None:
+            errors.append(line.strip())
+
+        quoted = shlex.quote(destination)
+        status = await remote.run(f"mkdir -p {quoted} && tar -xzpf - --no-same-owner -C {quoted}", collect, timeout=300, stdin=archive)
+        if status != 0:
+            raise Exception(f"Extracting artifacts into {destination} failed ({status}): {' '.join(errors)}")
+        report.sent = list(changed)
+
+    report.seconds = time.monotonic() - started
+    return report
+
+
+def format_bytes(count: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(count) < 1024 or unit == "GB":
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024
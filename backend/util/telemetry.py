@@ -0,0 +1,81 @@
+import time
+from typing import Awaitable, Callable
+from util.dtypes import TrainMetrics, TrainMetricsWindow, TrainDetails
+from util.helpers import get_log_format
+
+#### TRAINING TELEMETRY
+#
+# train_script.py emits one `metrics` event per optimizer step. Forwarding
+# each one would send the client thousands of messages on a long run, so
+# steps are folded into one window per `interval` seconds and the window goes
+# out as a single train_details message: mean loss, grad norm and throughput,
+# min loss, the latest learning rate and ETA, and peak memory. Anything else
+# (eval results, the stop event) flushes the open window first so the client
+# sees events in order.
+
+def summarize(points: list[TrainMetrics]) -> TrainMetricsWindow:
+    def mean(field: str) -> float | None:
+        values = [getattr(p, field) for p in points if getattr(p, field) is not None]
+        return round(sum(values) / len(values), 4) if values else None
+
+    memory = [p.memory_gb for p in points if p.memory_gb is not None]
+    last = points[-1]
+    return TrainMetricsWindow(
+        first_step=points[0].step,
+        last_step=last.step,
+        points=len(points),
+        epoch=last.epoch,
+        loss=mean("loss"),
+        min_loss=min(p.loss for p in points),
+        learning_rate=last.learning_rate,
+        grad_norm=mean("grad_norm"),
+        tokens_per_second=mean("tokens_per_second"),
+        samples_per_second=mean("samples_per_second"),
+        memory_gb=max(memory) if memory else None,
+        eta_seconds=last.eta_seconds,
+    )
+
+
+def window_log(window: TrainMetricsWindow) -> str:
+    steps = f"Step {window.last_step}" if window.points == 1 else f"Steps {window.first_step}-{window.last_step}"
+    parts = [f"loss: {window.loss:.4f}"]
+    if window.learning_rate is not None:
+        parts.append(f"lr: {window.learning_rate:.2e}")
+    if window.tokens_per_second is not None:
+        parts.append(f"{window.tokens_per_second:.0f} tok/s")
+    if window.memory_gb is not None:
+        parts.append(f"{window.memory_gb:.1f} GB")
+    if window.eta_seconds is not None:
+        parts.append(f"ETA {int(window.eta_seconds) // 60}m{int(window.eta_seconds) % 60:02d}s")
+    return f"{steps}: " + ", ".join(parts) + "\n"
+
+
+class TelemetryAggregator:
+    def __init__(self, send_handler: Callable[[dict], Awaitable[None]], interval: float = 2.0):
+        self.send_handler = send_handler
+        self.interval = interval
+        self.points: list[TrainMetrics] = []
+        self.window_started = time.monotonic()
+        self.received = 0
+        self.sent = 0
+
+    async def add(self, event: dict) -> None:
+        if not self.points:
+            self.window_started = time.monotonic()
+        self.points.append(TrainMetrics(**{k: v for k, v in event.items() if k != "event"}))
+        self.received += 1
+        if time.monotonic() - self.window_started >= self.interval:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self.points:
+            return
+        window = summarize(self.points)
+        self.points = []
+        self.sent += 1
+        await self.send_handler(TrainDetails(
+            type="train_details",
+            text="",
+            log=get_log_format(window_log(window)),
+            metrics=window,
+        ).model_dump(exclude_none=True))